@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Benchmarks of rally-ci internals."""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import yaml
+
+from rallyci.common.ssh import SSH
+from rallyci.providers import virsh
+from rallyci import root
+from rallyci.services import gerrit
+
+
+def percentile(values, percent):
+    """Return percentile of sorted list of values (nearest rank)."""
+    if not values:
+        return 0.0
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+def _get_stream_config(args, pub_dir):
+    projects = set()
+    with open(args.filename, encoding="utf-8") as fs:
+        for line in fs:
+            project = gerrit._get_project_name(json.loads(line))
+            if project:
+                projects.add(project)
+    return [
+        {"ssh-key": {"name": "default", "public": "", "private": ""}},
+        {"rally-ci": {"pub-dir": pub_dir}},
+        {"service": {"name": "gerrit", "module": "rallyci.services.gerrit",
+                     "silent": True, "ssh": {}}},
+        {"provider": {"name": "fake", "module": "rallyci.providers.fake",
+                      "max-jobs": args.max_jobs,
+                      "boot-time": args.boot_time,
+                      "script-time": args.script_time,
+                      "vms": {"fake": {}}}},
+        {"script": {"name": "noop", "data": "true"}},
+        {"job": {"name": "noop", "provider": "fake",
+                 "vms": [{"name": "fake", "scripts": ["noop"]}]}},
+        {"matrix": {"name": "bench", "projects": sorted(projects),
+                    "jobs": ["noop"], "merged-jobs": ["noop"]}},
+    ]
+
+
+@asyncio.coroutine
+def bench_stream(r, args):
+    """Replay recorded gerrit stream through Root/Task/Job path.
+
+    :param Root r:
+    """
+    latencies = []
+    started_jobs = []
+
+    def task_started(task):
+        started_jobs.extend(task.jobs)
+
+    def job_finished(job):
+        started_at = getattr(job, "started_at", None)
+        if started_at:
+            latencies.append(started_at - job.task_started_at)
+
+    r.task_start_handlers.append(task_started)
+    r.job_end_handlers.append(job_finished)
+    for prov in r.config.iter_providers():
+        r.providers[prov.name] = prov
+        yield from prov.start()
+    service = gerrit.Service(r, **r.config.data["service"]["gerrit"])
+
+    replay_started = time.time()
+    for i in range(args.repeat):
+        yield from service.replay(args.filename, args.rate)
+    replay_time = time.time() - replay_started
+    while r.tasks or r._running_cleanups:
+        yield from asyncio.sleep(0.01, loop=r.loop)
+    total_time = time.time() - replay_started
+
+    latencies.sort()
+    events = r.stats["gerrit-events-received"]
+    tasks = r.stats["tasks-started"]
+    print("Events parsed:   %d (%.1f events/s)" % (events,
+                                                   events / replay_time))
+    print("Events filtered: %d" % r.stats["gerrit-events-filtered"])
+    print("Tasks admitted:  %d (%.1f tasks/s)" % (tasks, tasks / replay_time))
+    print("Jobs finished:   %d of %d in %.2fs" % (len(latencies),
+                                                  len(started_jobs),
+                                                  total_time))
+    for p in (50, 90, 99):
+        print("Event to job start p%d: %.4fs" % (p, percentile(latencies, p)))
+
+
+def _print_latencies(name, values):
+    values = sorted(values)
+    print("%-8s p50: %.3fs p90: %.3fs max: %.3fs" % (
+        name, percentile(values, 50), percentile(values, 90), values[-1]))
+
+
+@asyncio.coroutine
+def bench_storage(storage, args):
+    """Measure clone and destroy latency of virsh storage backend.
+
+    :param storage: instance of one of virsh.BACKENDS
+    """
+    if args.url:
+        yield from storage.download(args.image, args.url)
+        yield from storage.snapshot(args.image, "1")
+    versions = yield from storage.get_versions(args.image)
+    if not versions:
+        raise Exception("Image %s not found (use --url)" % args.image)
+    version = max(versions)
+    loop = storage.ssh.loop
+    semaphore = asyncio.Semaphore(args.parallel, loop=loop)
+    clones = []
+    destroys = []
+
+    @asyncio.coroutine
+    def one(i):
+        name = "rci_bench_%d" % i
+        with (yield from semaphore):
+            started_at = time.time()
+            yield from storage.clone(args.image, name, version)
+            clones.append(time.time() - started_at)
+            started_at = time.time()
+            yield from storage.destroy(name)
+            destroys.append(time.time() - started_at)
+
+    started_at = time.time()
+    yield from asyncio.gather(*[one(i) for i in range(args.count)],
+                              loop=loop)
+    total = time.time() - started_at
+    print("%s: %d clones of %s@%s in %.2fs (parallel: %d)" % (
+        args.backend, args.count, args.image, version, total, args.parallel))
+    _print_latencies("clone", clones)
+    _print_latencies("destroy", destroys)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    stream = subparsers.add_parser("stream",
+                                   help="replay recorded gerrit stream")
+    stream.add_argument("filename", type=str, help="recorded stream")
+    stream.add_argument("--rate", type=float, default=0,
+                        help="events per second (default: max speed)")
+    stream.add_argument("--repeat", type=int, default=1)
+    stream.add_argument("--max-jobs", type=int, default=None)
+    stream.add_argument("--boot-time", type=float, default=0)
+    stream.add_argument("--script-time", type=float, default=0)
+    storage = subparsers.add_parser(
+        "storage", help="measure clone/destroy latency of virsh storage")
+    storage.add_argument("hostname", type=str)
+    storage.add_argument("--username", type=str, default="root")
+    storage.add_argument("--key", type=str, action="append")
+    storage.add_argument("--backend", choices=sorted(virsh.BACKENDS),
+                         required=True)
+    storage.add_argument("--option", type=str, action="append", default=[],
+                         help="backend option key=value "
+                              "(e.g. path=/ci, dataset=tank/ci, vg=ci)")
+    storage.add_argument("--image", type=str, required=True,
+                         help="existing image to clone")
+    storage.add_argument("--url", type=str,
+                         help="download image from url first")
+    storage.add_argument("--count", type=int, default=10)
+    storage.add_argument("--parallel", type=int, default=1)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("command is required")
+
+    loop = asyncio.get_event_loop()
+    if args.command == "storage":
+        ssh = SSH(loop, args.hostname, username=args.username, keys=args.key)
+        options = dict(option.split("=", 1) for option in args.option)
+        backend = virsh.BACKENDS[args.backend](ssh, **options)
+        try:
+            loop.run_until_complete(bench_storage(backend, args))
+        finally:
+            ssh.close()
+        return
+
+    with tempfile.TemporaryDirectory(prefix="rci_bench") as tmpdir:
+        cf = os.path.join(tmpdir, "config.yaml")
+        with open(cf, "w") as f:
+            f.write(yaml.safe_dump(_get_stream_config(args, tmpdir)))
+        r = root.Root(loop, cf, False)
+        r._load_config()
+        loop.run_until_complete(bench_stream(r, args))
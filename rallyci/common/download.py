@@ -0,0 +1,109 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import hashlib
+import logging
+import shlex
+
+LOG = logging.getLogger(__name__)
+
+FETCH_SCRIPT = """
+mkdir -p {dir}
+cd {dir}
+if [ -f {key} ] && ! sha256sum -c --quiet {key}.sha256; then
+    rm -f {key} {key}.sha256
+fi
+if [ ! -f {key} ]; then
+    curl -fsSL --retry 3 -C - -o {key}.part {url}
+    {verify}
+    mv {key}.part {key}
+    sha256sum {key} > {key}.sha256
+fi
+cp --reflink=auto {key} {dst}
+"""
+
+VERIFY = """echo {sha256}'  '{key}.part | sha256sum -c --quiet || \
+{{ rm -f {key}.part; exit 1; }}"""
+
+
+def parse_validators(headers):
+    """Return (etag, last-modified) of last response in `curl -I` output."""
+    etag = last_modified = ""
+    for line in headers.splitlines():
+        if line.startswith("HTTP/"):
+            etag = last_modified = ""
+            continue
+        key, sep, value = line.partition(":")
+        key = key.strip().lower()
+        if key == "etag":
+            etag = value.strip()
+        elif key == "last-modified":
+            last_modified = value.strip()
+    return etag, last_modified
+
+
+def get_key(url, etag="", last_modified=""):
+    data = "\n".join((url, etag, last_modified)).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class DownloadCache:
+    """Content addressed cache of downloaded files on remote host.
+
+    Files are keyed by url and ETag/Last-Modified of the resource, so a
+    changed resource is fetched again while unchanged one is copied from
+    cache. Interrupted downloads are resumed. Cached files are checked
+    against stored sha256 before use.
+    """
+
+    def __init__(self, ssh, cache_dir):
+        """
+        :param SSH ssh: connection to host
+        :param str cache_dir: path to cache on host
+        """
+        self.ssh = ssh
+        self.cache_dir = cache_dir
+        self._locks = {}
+
+    @asyncio.coroutine
+    def get_key(self, url):
+        err, headers, err = yield from self.ssh.out(
+            ["curl", "-fsSIL", url], check=False)
+        etag, last_modified = parse_validators(headers)
+        if not (etag or last_modified):
+            LOG.warning("No validators for %s, cached copy is never "
+                        "refreshed" % url)
+        return get_key(url, etag, last_modified)
+
+    @asyncio.coroutine
+    def fetch(self, url, dst, sha256=None):
+        """Copy resource to dst on remote host downloading it if needed.
+
+        :param str sha256: expected checksum of resource
+        """
+        key = yield from self.get_key(url)
+        verify = ""
+        if sha256:
+            verify = VERIFY.format(sha256=shlex.quote(sha256), key=key)
+        script = FETCH_SCRIPT.format(dir=shlex.quote(self.cache_dir),
+                                     key=key, url=shlex.quote(url),
+                                     dst=shlex.quote(dst), verify=verify)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock(loop=self.ssh.loop)
+        with (yield from lock):
+            LOG.info("Fetching %s (%s) to %s" % (url, key, dst))
+            yield from self.ssh.run("/bin/sh -e -s", stdin=script,
+                                    stderr=LOG.warning)
@@ -14,6 +14,8 @@
 
 
 import asyncio
+import codecs
+import collections
 import functools
 import logging
 import os
@@ -26,6 +28,8 @@ from rallyci.utils import LogDel
 
 LOG = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536
+
 
 class SSHError(Exception):
     pass
@@ -56,18 +60,55 @@ class SSHClient(asyncssh.SSHClient, LogDel):
 
 
 class SSHClientSession(asyncssh.SSHClientSession, LogDel):
+    """Session with binary channel.
+
+    Output is decoded as utf-8 before passing to callbacks (unless
+    decode_stdout is False). Writers should wait for drain() to respect
+    flow control of the channel.
+    """
 
-    def __init__(self, callbacks, *args, **kwargs):
+    def __init__(self, callbacks, loop, *args, decode_stdout=True, **kwargs):
         super().__init__(*args, **kwargs)
         self._stdout_cb, self._stderr_cb = callbacks
+        decoder = codecs.getincrementaldecoder("utf-8")
+        self._decoders = {asyncssh.EXTENDED_DATA_STDERR: decoder("replace")}
+        if decode_stdout:
+            self._decoders[None] = decoder("replace")
+        self._writable = asyncio.Event(loop=loop)
+        self._writable.set()
+
+    def _get_callback(self, datatype):
+        if datatype is None:
+            return self._stdout_cb
+        if datatype == asyncssh.EXTENDED_DATA_STDERR:
+            return self._stderr_cb
 
     def data_received(self, data, datatype):
-        if self._stdout_cb and datatype is None:
-            self._stdout_cb(data)
-        elif self._stderr_cb and (datatype == asyncssh.EXTENDED_DATA_STDERR):
-            self._stderr_cb(data)
+        cb = self._get_callback(datatype)
+        if cb:
+            decoder = self._decoders.get(datatype)
+            if decoder:
+                data = decoder.decode(data)
+            if data:
+                cb(data)
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self._writable.wait()
 
     def connection_lost(self, ex):
+        for datatype, decoder in self._decoders.items():
+            cb = self._get_callback(datatype)
+            data = decoder.decode(b"", final=True)
+            if cb and data:
+                cb(data)
+        self._writable.set()
         self._stdout_cb = None
         self._stderr_cb = None
 
@@ -75,7 +116,7 @@ class SSHClientSession(asyncssh.SSHClientSession, LogDel):
 class SSH(LogDel):
 
     def __init__(self, loop, hostname, username=None, keys=None, port=22,
-                 cb=None, jumphost=None):
+                 cb=None, jumphost=None, max_sessions=None):
         self.loop = loop
         self.username = username or pwd.getpwuid(os.getuid()).pw_name
         self.hostname = hostname
@@ -91,6 +132,10 @@ class SSH(LogDel):
             self.keys = None
         self._connecting = asyncio.Lock(loop=loop)
         self._connected = asyncio.Event(loop=loop)
+        if max_sessions:
+            self._sessions = asyncio.Semaphore(max_sessions, loop=loop)
+        else:
+            self._sessions = None
 
     def __repr__(self):
         return "<SSH %s@%s>" % (self.username, self.hostname)
@@ -117,46 +162,58 @@ class SSH(LogDel):
                 client_keys=self.keys, port=self.port)
             LOG.debug("Connected %s@%s" % (self.username, self.hostname))
 
+    @asyncio.coroutine
+    def _session(self):
+        """Return context manager limiting number of open channels."""
+        if self._sessions is None:
+            return _NoopContext()
+        return (yield from self._sessions)
+
     @asyncio.coroutine
     def run(self, cmd, stdin=None, stdout=None, stderr=None, check=True,
-            env=None):
+            env=None, decode=True):
         """Run command on remote server.
 
         :param string cmd: command to be executed
-        :param stdin: either string, bytes or file like object
+        :param stdin: str, bytes or file like object. Its read() may be a
+            coroutine (e.g. asyncio.StreamReader) returning str/bytes
+            chunks and empty chunk at EOF. Data is streamed with flow
+            control.
         :param stdout: executable (e.g. sys.stdout.write)
         :param stderr: executable (e.g. sys.stderr.write)
         :param boolean check: Raise exception if non-zero exit status.
+        :param boolean decode: Pass stdout as str. If False stdout gets raw
+            bytes. Stdout having set_channel method (e.g. Pipe) is given
+            the channel to pause reading.
         """
         if isinstance(cmd, list):
             cmd = _escape_cmd(cmd)
         cmd = _escape_env(env) + cmd
         LOG.debug("Running %s" % cmd)
         yield from self._ensure_connected()
-        session_factory = functools.partial(SSHClientSession, (stdout, stderr))
-        chan, session = yield from self.conn.create_session(session_factory,
-                                                            cmd, env=env or {})
-        if stdin:
-            if hasattr(stdin, "read"):
-                while True:
-                    chunk = stdin.read(4096)
-                    if hasattr(chunk, "decode"):
-                        chunk = chunk.decode("ascii")  # TODO
-                    if not chunk:
-                        break
-                    chan.write(chunk)
-                    # TODO: drain
-            else:
-                chan.write(stdin)
-            chan.write_eof()
-        yield from chan.wait_closed()
-        status = chan.get_exit_status()
+        with (yield from self._session()):
+            status, signal = yield from self._run(cmd, stdin, stdout,
+                                                  stderr, env, decode)
         if check and status == -1:
-            raise SSHProcessKilled(chan.get_exit_signal())
+            raise SSHProcessKilled(signal)
         if check and status != 0:
             raise SSHProcessFailed(status)
         return status
 
+    @asyncio.coroutine
+    def _run(self, cmd, stdin, stdout, stderr, env, decode=True):
+        session_factory = functools.partial(SSHClientSession, (stdout, stderr),
+                                            self.loop, decode_stdout=decode)
+        chan, session = yield from self.conn.create_session(
+            session_factory, cmd, env=env or {}, encoding=None)
+        if hasattr(stdout, "set_channel"):
+            stdout.set_channel(chan)
+        if stdin:
+            yield from _write_stdin(chan, session, stdin)
+            chan.write_eof()
+        yield from chan.wait_closed()
+        return chan.get_exit_status(), chan.get_exit_signal()
+
     @asyncio.coroutine
     def out(self, cmd, stdin=None, check=True, env=None):
         stdout = []
@@ -185,8 +242,9 @@ class SSH(LogDel):
     def get(self, *args, **kwargs):
         LOG.debug("SCP %s %s %s" % (args, kwargs, self))
         yield from self._ensure_connected()
-        with (yield from self.conn.start_sftp_client()) as sftp:
-            yield from sftp.get(*args, **kwargs)
+        with (yield from self._session()):
+            with (yield from self.conn.start_sftp_client()) as sftp:
+                yield from sftp.get(*args, **kwargs)
         LOG.debug("DONE SCP %s %s %s" % (args, kwargs, self))
 
     @asyncio.coroutine
@@ -215,6 +273,203 @@ class SSH(LogDel):
         return process.returncode
 
 
+class Pipe:
+    """Buffer connecting stdout of one command to stdin of another.
+
+    Reading of source channel is paused while more than high_water bytes
+    are buffered, so slow receiver doesn't make daemon buffer whole stream.
+    """
+
+    def __init__(self, loop, high_water=CHUNK_SIZE * 16):
+        self.loop = loop
+        self.high_water = high_water
+        self.size = 0
+        self._chunks = collections.deque()
+        self._chan = None
+        self._eof = False
+        self._readable = asyncio.Event(loop=loop)
+
+    def set_channel(self, chan):
+        self._chan = chan
+
+    def __call__(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+        self._readable.set()
+        if self._chan and self.size > self.high_water:
+            self._chan.pause_reading()
+
+    def feed_eof(self):
+        self._eof = True
+        self._readable.set()
+
+    @asyncio.coroutine
+    def read(self, n=-1):
+        while not self._chunks:
+            if self._eof:
+                return b""
+            self._readable.clear()
+            yield from self._readable.wait()
+        data = self._chunks.popleft()
+        self.size -= len(data)
+        if self._chan and self.size <= self.high_water // 2:
+            self._chan.resume_reading()
+        return data
+
+
+@asyncio.coroutine
+def pipe(src, src_cmd, dst, dst_cmd, loop):
+    """Stream output of command on src to command on dst.
+
+    Equivalent of `ssh src src_cmd | ssh dst dst_cmd` through the daemon.
+
+    :param SSH src:
+    :param SSH dst:
+    """
+    buf = Pipe(loop)
+
+    @asyncio.coroutine
+    def send():
+        try:
+            yield from src.run(src_cmd, stdout=buf, stderr=LOG.warning,
+                               decode=False)
+        finally:
+            buf.feed_eof()
+
+    futures = [asyncio.async(send(), loop=loop),
+               asyncio.async(dst.run(dst_cmd, stdin=buf, stderr=LOG.warning),
+                             loop=loop)]
+    try:
+        yield from asyncio.gather(*futures, loop=loop)
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+
+class _NoopContext:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class SSHPool:
+    """Share SSH connections to the same remote account.
+
+    Connections are keyed by (hostname, port, username, keys). Every get()
+    should be paired with put(). Connections not used by anyone for
+    idle_timeout seconds are closed.
+    """
+
+    def __init__(self, loop, idle_timeout=300, max_sessions=10):
+        """
+        :param int max_sessions: max channels per connection (should not
+            exceed MaxSessions of sshd)
+        """
+        self.loop = loop
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.hits = 0
+        self.misses = 0
+        self._connections = {}
+        self._users = collections.Counter()
+        self._idle_since = {}
+
+    def get(self, hostname, username=None, keys=None, port=22, **kwargs):
+        self.evict()
+        key = (hostname, port, username, tuple(keys or ()))
+        ssh = self._connections.get(key)
+        if ssh is None:
+            self.misses += 1
+            ssh = SSH(self.loop, hostname, username=username, keys=keys,
+                      port=port, max_sessions=self.max_sessions, **kwargs)
+            ssh.pool_key = key
+            self._connections[key] = ssh
+        else:
+            self.hits += 1
+        self._users[key] += 1
+        self._idle_since.pop(key, None)
+        return ssh
+
+    def put(self, ssh, close=False):
+        """Return connection to pool.
+
+        :param bool close: close connection immediately if it is not used
+            anymore (e.g. remote host is going to be destroyed)
+        """
+        key = ssh.pool_key
+        self._users[key] -= 1
+        if self._users[key] <= 0:
+            del self._users[key]
+            if close:
+                self._close(key)
+            else:
+                self._idle_since[key] = time.time()
+        self.evict()
+
+    def _close(self, key):
+        self._idle_since.pop(key, None)
+        ssh = self._connections.pop(key, None)
+        if ssh:
+            LOG.debug("Closing pooled connection %s" % ssh)
+            ssh.close()
+
+    def evict(self):
+        deadline = time.time() - self.idle_timeout
+        for key, idle_since in list(self._idle_since.items()):
+            if idle_since < deadline:
+                self._close(key)
+
+    def close(self):
+        for key in list(self._connections):
+            self._close(key)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "connections": len(self._connections),
+                "idle": len(self._idle_since)}
+
+
+@asyncio.coroutine
+def _await(obj):
+    if hasattr(obj, "__await__"):
+        return (yield from obj.__await__())
+    return (yield from obj)
+
+
+@asyncio.coroutine
+def _write_stdin(chan, session, stdin):
+    """Stream stdin to channel waiting for drain after every chunk.
+
+    :param chan: asyncssh channel
+    :param SSHClientSession session:
+    :param stdin: see SSH.run
+    """
+    def write(chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        chan.write(chunk)
+
+    if isinstance(stdin, str):
+        stdin = stdin.encode("utf-8")
+    if isinstance(stdin, (bytes, bytearray)):
+        data = memoryview(stdin)
+        for i in range(0, len(data), CHUNK_SIZE):
+            write(bytes(data[i:i + CHUNK_SIZE]))
+            yield from session.drain()
+    else:
+        while True:
+            chunk = stdin.read(CHUNK_SIZE)
+            if not isinstance(chunk, (str, bytes)):
+                chunk = yield from _await(chunk)
+            if not chunk:
+                break
+            write(chunk)
+            yield from session.drain()
+
+
 def _escape(string):
     return string.replace(r"'", r"'\''")
 
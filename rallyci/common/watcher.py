@@ -0,0 +1,80 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Resolve many pending keys with single periodic poll.
+
+    Used to find addresses of many booting VMs with one remote command
+    per tick instead of one command per VM. Polling runs only while
+    somebody is waiting.
+    """
+
+    def __init__(self, loop, poll, interval=1):
+        """
+        :param poll: coroutine function returning dict key -> value of all
+            keys which could be resolved at the moment
+        :param interval: seconds between polls
+        """
+        self.loop = loop
+        self.poll = poll
+        self.interval = interval
+        self._waiters = {}
+        self._future = None
+
+    @asyncio.coroutine
+    def wait(self, keys, timeout=None):
+        """Wait until any of keys is resolved and return its value.
+
+        :raises asyncio.TimeoutError:
+        """
+        fut = asyncio.Future(loop=self.loop)
+        for key in keys:
+            self._waiters.setdefault(key, []).append(fut)
+        if self._future is None or self._future.done():
+            self._future = asyncio.async(self._run(), loop=self.loop)
+        try:
+            return (yield from asyncio.wait_for(fut, timeout, loop=self.loop))
+        finally:
+            for key in keys:
+                waiters = self._waiters.get(key, [])
+                if fut in waiters:
+                    waiters.remove(fut)
+                if not waiters:
+                    self._waiters.pop(key, None)
+
+    @asyncio.coroutine
+    def _run(self):
+        while self._waiters:
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            try:
+                found = yield from self.poll()
+            except Exception:
+                LOG.exception("Error polling %s" % self.poll)
+                continue
+            for key, value in found.items():
+                for fut in self._waiters.pop(key, []):
+                    if not fut.done():
+                        fut.set_result(value)
+            for key, waiters in list(self._waiters.items()):
+                waiters = [fut for fut in waiters if not fut.done()]
+                if waiters:
+                    self._waiters[key] = waiters
+                else:
+                    del self._waiters[key]
@@ -70,6 +70,9 @@ class Config:
     def get_ssh_keys(self, keytype="public"):
         return [k[keytype] for k in self.data["ssh-key"].values()]
 
+    def get_configured_projects(self):
+        return sorted(self._configured_projects)
+
     def is_project_configured(self, project):
         return project in self._configured_projects
 
@@ -119,10 +122,14 @@ class Config:
         return getattr(module, class_name)(cfg, *args, **kwargs)
 
     def iter_instances(self, section, class_name):
+        for name, instance in self.iter_named_instances(section, class_name):
+            yield instance
+
+    def iter_named_instances(self, section, class_name):
         section = self.data.get(section, {})
-        for config in section.values():
+        for name, config in section.items():
             module = self._get_module(config["module"])
-            yield getattr(module, class_name)(self.root, **config)
+            yield name, getattr(module, class_name)(self.root, **config)
 
     def iter_providers(self):
         for cfg in self.data.get("provider", {}).values():
@@ -22,6 +22,22 @@ import weakref
 from rallyci import utils
 
 
+class Barrier:
+    """Sync point for scripts running concurrently on job vms."""
+
+    def __init__(self, loop):
+        self.parties = 0
+        self.arrived = 0
+        self.event = asyncio.Event(loop=loop)
+
+    @asyncio.coroutine
+    def wait(self):
+        self.arrived += 1
+        if self.arrived >= self.parties:
+            self.event.set()
+        yield from self.event.wait()
+
+
 class Job:
     finished_at = None
 
@@ -36,6 +52,7 @@ class Job:
         self.task_id = task.id
         self.task_started_at = task.started_at
         self.task_local_config = task.local_config
+        self.event_type = task.event.event_type
         self.error = 256
 
         self.voting = config.get("voting", voting)
@@ -49,6 +66,9 @@ class Job:
         self.log_path = os.path.join(self.task.id, config["name"])
         self.log.debug("Job %s initialized." % self.id)
         self.vms = []
+        self.vm_timings = []
+        self.vm_logs = {}
+        self._vm_died = asyncio.Future(loop=self.root.loop)
         self.console_listeners = []
 
     @property
@@ -63,14 +83,18 @@ class Job:
         self.status = status
         self.root.job_updated(self)
 
-    def _data_cb(self, fd, data):
+    def _data_cb(self, fd, data, vm_log=None):
         for cb in self.console_listeners:
             try:
                 cb((fd, data))
             except Exception:
                 self.root.log.exception("")
-        self.console_log.write(data.encode("utf-8"))
+        data = data.encode("utf-8")
+        self.console_log.write(data)
         self.console_log.flush()
+        if vm_log:
+            vm_log.write(data)
+            vm_log.flush()
 
     @asyncio.coroutine
     def _run(self):
@@ -78,42 +102,148 @@ class Job:
         :param dict conf: vm item from job config
         """
         self.provider = self.root.providers[self.config["provider"]]
-        for vm_conf in self.config["vms"]:
-            vm = yield from self.provider.get_vm(vm_conf["name"], self)
-            self.vms.append((vm, vm_conf))
+        yield from self.root.scheduler.acquire(self)
+        yield from self._get_vms()
 
         pub_dir = self.root.config.get_value("pub-dir", "/tmp/rally-pub")
         self.path = os.path.join(pub_dir, self.task_id, self.config["name"])
         os.makedirs(self.path)
         path = self.path + "/console.log"
         self.console_log = open(path, "wb")
+        if self._is_concurrent():
+            for i, (vm, conf) in enumerate(self.vms):
+                path = "%s/console-%d-%s.log" % (self.path, i, conf["name"])
+                self.vm_logs[vm] = open(path, "wb")
         self.started_at = time.time()
-        fut = self._run_scripts("scripts")
-        return (yield from asyncio.wait_for(fut, self.timeout,
-                                            loop=self.root.loop))
+        fut = asyncio.async(self._run_scripts("scripts"), loop=self.root.loop)
+        try:
+            done, pending = yield from asyncio.wait(
+                [fut, self._vm_died], timeout=self.timeout,
+                return_when=asyncio.FIRST_COMPLETED, loop=self.root.loop)
+        finally:
+            fut.cancel()
+        if fut in done:
+            return fut.result()
+        if self._vm_died in done:
+            vm, reason = self._vm_died.result()
+            raise Exception("VM %s died (%s)" % (vm, reason))
+        raise asyncio.TimeoutError()
+
+    def vm_died(self, vm, reason):
+        """Called by provider when VM of job is stopped unexpectedly."""
+        self.log.info("VM %s of %s died (%s)" % (vm, self, reason))
+        if not self._vm_died.done():
+            self._vm_died.set_result((vm, reason))
+
+    @asyncio.coroutine
+    def _get_vm(self, vm_conf):
+        started_at = time.time()
+        vm = yield from self.provider.get_vm(vm_conf["name"], self)
+        self.vm_timings.append((vm_conf["name"], time.time() - started_at))
+        return vm
+
+    @asyncio.coroutine
+    def _get_vms(self):
+        """Provision all VMs of job concurrently.
+
+        If any VM fails the rest are cancelled. VMs which were already
+        provisioned are destroyed by provider cleanup, VMs cancelled in
+        the middle of provisioning are destroyed by provider itself.
+        """
+        self.set_status("provisioning")
+        confs = self.config["vms"]
+        futures = [asyncio.async(self._get_vm(conf), loop=self.root.loop)
+                   for conf in confs]
+        started_at = time.time()
+        try:
+            vms = yield from asyncio.gather(*futures, loop=self.root.loop)
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            yield from asyncio.wait(futures, loop=self.root.loop)
+            raise
+        self.vms = list(zip(vms, confs))
+        self.log.info("VMs for %s provisioned in %.1fs (%s)" % (
+            self, time.time() - started_at,
+            ", ".join("%s: %.1fs" % t for t in self.vm_timings)))
 
     def get_script(self, script_name):
         return self.root.config.get_script(script_name,
                                            self.task_local_config)
 
+    def _is_concurrent(self):
+        return self.config.get("concurrent", False) and len(self.vms) > 1
+
+    @asyncio.coroutine
+    def _run_vm_scripts(self, vm, scripts, update_status, barriers=None):
+        """Run scripts on vm one by one.
+
+        Items like {"barrier": "name"} make vm wait until all vms having
+        the same barrier reach it. Barriers are ignored if job is not
+        concurrent.
+
+        :returns: exit status of first failed script or None
+        """
+        vm_log = self.vm_logs.get(vm)
+        for script in scripts:
+            if isinstance(script, dict):
+                if barriers:
+                    yield from barriers[script["barrier"]].wait()
+                continue
+            if update_status:
+                self.set_status(script)
+            script = self.root.config.get_script(script,
+                                                 self.task_local_config)
+            ssh = yield from vm.get_ssh(script.get("user", "root"))
+            cmd = script.get("interpreter", "/bin/bash -xe -s")
+            self.root.log.debug("Running cmd %s" % cmd)
+            e = yield from ssh.run(cmd, stdin=script["data"], env=self.env,
+                                   stdout=partial(self._data_cb, 1,
+                                                  vm_log=vm_log),
+                                   stderr=partial(self._data_cb, 2,
+                                                  vm_log=vm_log),
+                                   check=False)
+            self.root.log.debug("DONE")
+            if e:
+                return e
+
     @asyncio.coroutine
     def _run_scripts(self, key, update_status=True):
-        for vm, conf in self.vms:
-            for script in conf.get(key, []):
-                if update_status:
-                    self.set_status(script)
-                script = self.root.config.get_script(script,
-                                                     self.task_local_config)
-                ssh = yield from vm.get_ssh(script.get("user", "root"))
-                cmd = script.get("interpreter", "/bin/bash -xe -s")
-                self.root.log.debug("Running cmd %s" % cmd)
-                e = yield from ssh.run(cmd, stdin=script["data"], env=self.env,
-                                       stdout=partial(self._data_cb, 1),
-                                       stderr=partial(self._data_cb, 2),
-                                       check=False)
-                self.root.log.debug("DONE")
+        if not self._is_concurrent():
+            for vm, conf in self.vms:
+                e = yield from self._run_vm_scripts(vm, conf.get(key, []),
+                                                    update_status)
                 if e:
                     return e
+            return
+
+        barriers = {}
+        for vm, conf in self.vms:
+            for script in conf.get(key, []):
+                if isinstance(script, dict):
+                    name = script["barrier"]
+                    if name not in barriers:
+                        barriers[name] = Barrier(self.root.loop)
+                    barriers[name].parties += 1
+        pending = [asyncio.async(self._run_vm_scripts(vm, conf.get(key, []),
+                                                      update_status,
+                                                      barriers),
+                                 loop=self.root.loop)
+                   for vm, conf in self.vms]
+        try:
+            while pending:
+                done, pending = yield from asyncio.wait(
+                    pending, loop=self.root.loop,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    e = fut.result()
+                    if e:
+                        return e
+        finally:
+            for fut in pending:
+                fut.cancel()
+            if pending:
+                yield from asyncio.wait(pending, loop=self.root.loop)
 
     @asyncio.coroutine
     def cleanup(self):
@@ -126,10 +256,12 @@ class Job:
                 for src, dst in conf.get("publish", []):
                     ssh = yield from vm.get_ssh()
                     yield from ssh.scp_get(src, os.path.join(self.path, dst))
-                    ssh.close()
         except Exception:
             self.log.exception("Error while publishing %s" % self)
-        yield from self.provider.cleanup(self)
+        try:
+            yield from self.provider.cleanup(self)
+        finally:
+            self.root.scheduler.release(self)
         for cb in self.root.job_end_handlers:
             cb(self)  # TODO: move it to root
 
@@ -153,12 +285,30 @@ class Job:
             self.finished_at = time.time()
         self.set_status(self.status)  # TODO: fix cleanup in http status
 
+    def get_result(self):
+        """Return result of finished job to be stored in journal."""
+        return {"status": self.status,
+                "error": self.error,
+                "started_at": getattr(self, "started_at", None),
+                "finished_at": self.finished_at,
+                "log_path": self.log_path}
+
+    def restore(self, result):
+        """Restore finished job from result returned by get_result."""
+        self.status = result["status"]
+        self.error = result["error"]
+        if result["started_at"]:
+            self.started_at = result["started_at"]
+        self.finished_at = result["finished_at"]
+        self.log_path = result["log_path"]
+
     def to_dict(self):
         return {"id": self.id,
                 "name": self.config["name"],
                 "status": self.status,
                 "task": self.task_id,
                 "finished_at": self.finished_at,
+                "vm_timings": self.vm_timings,
                 "seconds": int(time.time()) - self.task_started_at,
                 }
 
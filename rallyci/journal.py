@@ -0,0 +1,152 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import collections
+from concurrent import futures
+import json
+import logging
+import os
+
+from rallyci import utils
+
+LOG = logging.getLogger(__name__)
+
+
+class Journal:
+    """Append-only log of admitted tasks, job results and reviews.
+
+    Every record is json encoded dict on separate line. Records are
+    applied to in-memory state immediately and written to disk in
+    batches by single thread executor, so event loop is never blocked
+    by disk io.
+
+    Record types:
+        task-started: task, service, raw_event
+        job-status: task, job, status (and result if job is finished)
+        task-finished: task, summary
+        review: id, service, cmd
+        published: id
+    """
+
+    def __init__(self, loop, filename, keep_finished=10):
+        """
+        :param str filename: path to journal file
+        :param int keep_finished: number of finished task summaries kept
+        """
+        self.loop = loop
+        self.filename = filename
+        self.closed = False
+        self.tasks = collections.OrderedDict()
+        self.reviews = collections.OrderedDict()
+        self.finished = collections.deque(maxlen=keep_finished)
+        self._pending = []
+        self._flushing = None
+        self._executor = futures.ThreadPoolExecutor(1)
+
+    def _apply(self, record):
+        kind = record["type"]
+        if kind == "task-started":
+            self.tasks[record["task"]] = {"service": record["service"],
+                                          "raw_event": record["raw_event"],
+                                          "jobs": {}}
+        elif kind == "job-status":
+            task = self.tasks.get(record["task"])
+            if task is not None and "result" in record:
+                task["jobs"][record["job"]] = record["result"]
+        elif kind == "task-finished":
+            self.tasks.pop(record["task"], None)
+            if record.get("summary"):
+                self.finished.append(record["summary"])
+        elif kind == "review":
+            self.reviews[record["id"]] = record
+        elif kind == "published":
+            self.reviews.pop(record["id"], None)
+
+    def _get_live_records(self):
+        for summary in self.finished:
+            yield {"type": "task-finished", "task": None, "summary": summary}
+        for task_id, task in self.tasks.items():
+            yield {"type": "task-started", "task": task_id,
+                   "service": task["service"],
+                   "raw_event": task["raw_event"]}
+            for name, result in task["jobs"].items():
+                yield {"type": "job-status", "task": task_id, "job": name,
+                       "status": result["status"], "result": result}
+        for review in self.reviews.values():
+            yield review
+
+    def load(self):
+        """Replay journal and compact it.
+
+        Called once on startup before any record is written.
+        """
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # last record may be incomplete after crash
+                        LOG.warning("Skipping broken journal record %r" %
+                                    line)
+        except FileNotFoundError:
+            pass
+        utils.makedirs(os.path.dirname(self.filename))
+        with open(self.filename + ".tmp", "w") as f:
+            for record in self._get_live_records():
+                f.write(json.dumps(record) + "\n")
+        os.replace(self.filename + ".tmp", self.filename)
+        LOG.info("Journal loaded: %d unfinished tasks, %d unpublished "
+                 "reviews" % (len(self.tasks), len(self.reviews)))
+
+    def record(self, record):
+        """Apply record and schedule writing it to disk.
+
+        :param dict record: record with "type" key
+        """
+        if self.closed:
+            return
+        self._apply(record)
+        self._pending.append(json.dumps(record) + "\n")
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.async(self._flush(), loop=self.loop)
+
+    def _write(self, lines):
+        with open(self.filename, "a") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @asyncio.coroutine
+    def _flush(self):
+        while self._pending:
+            lines, self._pending = self._pending, []
+            try:
+                yield from self.loop.run_in_executor(self._executor,
+                                                     self._write, lines)
+            except Exception:
+                LOG.exception("Error writing %d journal records" % len(lines))
+
+    @asyncio.coroutine
+    def close(self):
+        """Write pending records and stop recording.
+
+        Tasks interrupted by shutdown stay unfinished in journal and are
+        resubmitted on next start.
+        """
+        self.closed = True
+        if self._flushing is not None:
+            yield from self._flushing
+        self._executor.shutdown(wait=False)
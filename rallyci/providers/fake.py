@@ -0,0 +1,89 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""Provider which doesn't boot anything. Used for testing and benchmarks."""
+
+import asyncio
+
+from rallyci import base
+
+
+class Provider(base.BaseProvider):
+
+    def __init__(self, root, config):
+        """
+        :param dict config: provider config
+        """
+        self.root = root
+        self.config = config
+        self.name = config["name"]
+
+    @asyncio.coroutine
+    def start(self):
+        yield from asyncio.sleep(0)
+
+    @asyncio.coroutine
+    def get_vm(self, name, job):
+        yield from asyncio.sleep(self.config.get("boot-time", 0))
+        return VM(self, name)
+
+    @asyncio.coroutine
+    def cleanup(self, job):
+        yield from asyncio.sleep(0)
+
+    @asyncio.coroutine
+    def stop(self):
+        yield from asyncio.sleep(0)
+
+
+class VM(base.BaseVM):
+
+    def __init__(self, provider, name):
+        self.provider = provider
+        self.name = name
+
+    def __repr__(self):
+        return "<FakeVM %s>" % self.name
+
+    @asyncio.coroutine
+    def get_ssh(self, username="root"):
+        yield from asyncio.sleep(0)
+        return SSH(self.provider.config.get("script-time", 0))
+
+    @asyncio.coroutine
+    def run_script(self, script):
+        ssh = yield from self.get_ssh()
+        return (yield from ssh.run(script["data"]))
+
+
+class SSH:
+
+    def __init__(self, script_time):
+        self.script_time = script_time
+
+    @asyncio.coroutine
+    def run(self, cmd, stdin=None, stdout=None, stderr=None, check=True,
+            env=None):
+        yield from asyncio.sleep(self.script_time)
+        if stdout:
+            stdout("%s\n" % cmd)
+        return 0
+
+    @asyncio.coroutine
+    def scp_get(self, src, dst):
+        yield from asyncio.sleep(0)
+        return 0
+
+    def close(self):
+        pass
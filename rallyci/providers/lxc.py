@@ -15,18 +15,34 @@
 import asyncio
 import collections
 import functools
+import logging
 import os.path
 import re
-import time
 
 from rallyci import base
-from rallyci.common.ssh import SSH
+from rallyci.common import watcher
 from rallyci import utils
 
+LOG = logging.getLogger(__name__)
+
 COMMON_OPTS = (("-B", "backingstore"), )
 CREATE_OPTS = (("--zfsroot", "zfsroot"), )
 
-RE_LXC_IP = re.compile(r"IP:\s+([\d\.]+)$")
+RE_LXC_IP = re.compile(r"\d+\.\d+\.\d+\.\d+")
+
+
+def parse_lxc_ls(data):
+    """Parse output of `lxc-ls -f -F name,ipv4`.
+
+    :returns: dict container name -> first ipv4 address
+    """
+    found = {}
+    for line in data.splitlines()[1:]:
+        name, sep, addresses = line.strip().partition(" ")
+        m = RE_LXC_IP.search(addresses)
+        if m:
+            found[name] = m.group(0)
+    return found
 
 
 class Host:
@@ -36,9 +52,13 @@ class Host:
         self.ssh = ssh
 
         self.job_vm = {}
+        self._owned = set()
         self._building_images = collections.defaultdict(
                 functools.partial(asyncio.Lock, loop=provider.root.loop))
         self._create_opts = ["-B", "btrfs"]
+        self.ip_watcher = watcher.Watcher(
+            provider.root.loop, self._get_addresses,
+            provider.cfg.get("ip-poll-interval", 1))
 
     @asyncio.coroutine
     def update_stats(self):
@@ -81,33 +101,42 @@ class Host:
             for script in self.provider.cfg["vms"][image].get("build-scripts",
                                                               []):
                 yield from vm.run_script(script)
+            vm.close()
             cmd = ["lxc-stop", "-n", image]
             yield from self.ssh.run(cmd)
 
     @asyncio.coroutine
-    def _get_ip(self, name, timeout=60):
-        _start = time.time()
-        cmd = ["lxc-info", "-n", name]
+    def _get_addresses(self):
+        cmd = ["lxc-ls", "-f", "-F", "name,ipv4"]
         data = []
-        while True:
-            yield from asyncio.sleep(1)
-            yield from self.ssh.run(cmd, stdout=data.append)
-            for line in "".join(data).splitlines():
-                m = RE_LXC_IP.match(line)
-                if m:
-                    return m.group(1)
-            if time.time() > (_start + timeout):
-                raise Exception("Timeout waiting for %s" % name)
+        yield from self.ssh.run(cmd, stdout=data.append, check=False)
+        return parse_lxc_ls("".join(data))
+
+    @asyncio.coroutine
+    def _get_ip(self, name, timeout=60):
+        try:
+            return (yield from self.ip_watcher.wait([name], timeout))
+        except asyncio.TimeoutError:
+            raise Exception("Timeout waiting for %s" % name)
 
     @asyncio.coroutine
     def get_vm(self, image, job):
         yield from self._build_image(image, job)
         name = utils.get_rnd_name("rci_")
-        cmd = ["lxc-clone", "-s", "-o", image, "-n", name]
-        yield from self.ssh.run(cmd, stderr=print)
-        cmd = ["lxc-start", "-d", "-n", name]
-        yield from self.ssh.run(cmd, stderr=print)
-        ip = yield from self._get_ip(name)
+        self._owned.add(name)
+        try:
+            cmd = ["lxc-clone", "-s", "-o", image, "-n", name]
+            yield from self.ssh.run(cmd, stderr=print)
+            cmd = ["lxc-start", "-d", "-n", name]
+            yield from self.ssh.run(cmd, stderr=print)
+            ip = yield from self._get_ip(name)
+        except BaseException:
+            # container is not returned to job, so nobody else will destroy it
+            LOG.info("Destroying unfinished %s" % name)
+            yield from self.ssh.run(["lxc-destroy", "-f", "-n", name],
+                                    check=False)
+            self._owned.discard(name)
+            raise
         vm = VM(self, job, ip, name)
         if job not in self.job_vm:
             self.job_vm[job] = []
@@ -117,8 +146,26 @@ class Host:
     @asyncio.coroutine
     def cleanup(self, job):
         for vm in self.job_vm.pop(job, []):
+            vm.close()
             cmd = ["lxc-destroy", "-f", "-n", vm.name]
             yield from self.ssh.run(cmd, stdout=print)
+            self._owned.discard(vm.name)
+
+    @asyncio.coroutine
+    def reap_orphans(self):
+        """Destroy rci_* containers not belonging to running jobs.
+
+        :returns: number of destroyed containers
+        """
+        status, out, err = yield from self.ssh.out(["lxc-ls", "-1"],
+                                                   check=False)
+        names = [name for name in out.split()
+                 if name.startswith("rci_") and name not in self._owned]
+        results = yield from asyncio.gather(
+            *[self.ssh.run(["lxc-destroy", "-f", "-n", name], check=False)
+              for name in names],
+            return_exceptions=True, loop=self.provider.root.loop)
+        return len([r for r in results if r == 0])
 
 
 class Provider(base.BaseProvider):
@@ -139,15 +186,15 @@ class Provider(base.BaseProvider):
         self.job_host = {}
         self.hosts = []
         for host_cfg in cfg.get("hosts"):
-            self.hosts.append(Host(self, SSH(loop=self.root.loop, **host_cfg)))
+            self.hosts.append(Host(self, root.ssh_pool.get(**host_cfg)))
 
     @asyncio.coroutine
     def get_vm(self, image, job):
-        host = self.job_host.get(job)
-        if host is None:
-            with (yield from self.gethost_lock):
+        with (yield from self.gethost_lock):
+            host = self.job_host.get(job)
+            if host is None:
                 host = yield from self._get_host()
-            self.job_host[job] = host
+                self.job_host[job] = host
         vm = yield from host.get_vm(image, job)
         return vm
 
@@ -160,11 +207,31 @@ class Provider(base.BaseProvider):
                 yield from host.update_stats()
                 if host.num_containers < self.cfg.get("max_containers", 8):
                     return host
-            yield from asyncio.sleep(15)
+            yield from self.root.scheduler.wait_release(15)
+
+    @asyncio.coroutine
+    def reap_orphans(self):
+        results = yield from asyncio.gather(
+            *[host.reap_orphans() for host in self.hosts],
+            return_exceptions=True, loop=self.root.loop)
+        reaped = sum(r for r in results if not isinstance(r, Exception))
+        if reaped:
+            LOG.info("Destroyed %d orphaned containers" % reaped)
+        self.root.stats["orphans-reaped"] += reaped
+        return reaped
+
+    @asyncio.coroutine
+    def _sweep_orphans(self):
+        while True:
+            yield from asyncio.sleep(self.cfg.get("orphan-sweep-interval",
+                                                  600), loop=self.root.loop)
+            yield from self.reap_orphans()
 
     @asyncio.coroutine
     def start(self):
-        yield from asyncio.sleep(0)
+        yield from self.reap_orphans()
+        self.sweep_future = asyncio.async(self._sweep_orphans(),
+                                          loop=self.root.loop)
 
     @asyncio.coroutine
     def boot(self, name):
@@ -178,7 +245,7 @@ class Provider(base.BaseProvider):
 
     @asyncio.coroutine
     def stop(self):
-        pass
+        self.sweep_future.cancel()
 
 
 class VM(base.BaseVM):
@@ -189,6 +256,7 @@ class VM(base.BaseVM):
         self.job = job
         self.ip = ip
         self.name = name
+        self._ssh_cache = {}
 
     @asyncio.coroutine
     def run_script(self, script_name):
@@ -203,7 +271,20 @@ class VM(base.BaseVM):
 
     @asyncio.coroutine
     def get_ssh(self, username="root"):
-        ssh = SSH(self.provider.root.loop, self.ip,
-                  username=username, keys=[self.provider.privkey])
-        yield from ssh.wait()
+        ssh = self._ssh_cache.get(username)
+        if ssh is None:
+            ssh = self.provider.root.ssh_pool.get(
+                self.ip, username=username, keys=[self.provider.privkey])
+            self._ssh_cache[username] = ssh
+        try:
+            yield from ssh.wait()
+        except BaseException:
+            del self._ssh_cache[username]
+            self.provider.root.ssh_pool.put(ssh, close=True)
+            raise
         return ssh
+
+    def close(self):
+        for ssh in self._ssh_cache.values():
+            self.provider.root.ssh_pool.put(ssh, close=True)
+        self._ssh_cache = {}
@@ -13,36 +13,67 @@
 #    limitations under the License.
 
 import asyncio
+import collections
 import copy
-import contextlib
+import functools
+import math
 import time
 import os
-import random
 import re
 import logging
-import tempfile
 from xml.etree import ElementTree as et
+from xml.sax import saxutils
 
 from clis import clis
 
+from rallyci.common.download import DownloadCache
+from rallyci.common.ssh import pipe
+from rallyci.common import watcher
 from rallyci import utils
-from rallyci.common.ssh import SSH
 
 
 LOG = logging.getLogger(__name__)
 
 RE_LA = re.compile(r".*load average: (\d+\.\d+),.*")
-RE_MEM = re.compile(r".*Mem: +\d+ +\d+ +(\d+) +\d+ +\d+ +(\d+).*")
+RE_MEM = re.compile(r".*Mem: +(\d+) +\d+ +(\d+) +\d+ +\d+ +(\d+).*")
+RE_NPROC = re.compile(r"^(\d+)$", re.MULTILINE)
+RE_EVENT = re.compile(r"event 'lifecycle' for domain (\S+): (\w+) (\w+)")
 IFACE_RE = re.compile(r"\d+: ([a-z]+)(\d+): .*")
-IP_RE = re.compile(r"(\d+\.\d+\.\d+\.\d+)\s")
+IP_RE = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
+MAC_RE = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", re.IGNORECASE)
+NULL_MAC = "00:00:00:00:00:00"
+DEFAULT_CACHE_DIR = "/var/cache/rally-ci"
+
+
+def parse_neighbours(data):
+    """Parse arp table and/or dnsmasq leases.
+
+    :param str data: output of `cat /proc/net/arp <leases files>`
+    :returns: dict mac -> ip
+    """
+    found = {}
+    for line in data.splitlines():
+        ip = mac = None
+        for token in line.split():
+            if ip is None and IP_RE.match(token):
+                ip = token
+            elif mac is None and MAC_RE.match(token):
+                mac = token.lower()
+        if ip and mac and mac != NULL_MAC:
+            found[mac] = ip
+    return found
 
 
 class ZFS:
 
+    supports_streaming = True
+
     def __init__(self, ssh, path, dataset, **kwargs):
         self.ssh = ssh
         self.path = path
         self.dataset = dataset
+        self.cache = DownloadCache(ssh, kwargs.get("cache-dir",
+                                                   DEFAULT_CACHE_DIR))
 
     @asyncio.coroutine
     def create(self, name):
@@ -57,16 +88,47 @@ class ZFS:
                 for f in ls.splitlines()]
 
     @asyncio.coroutine
-    def clone(self, src, dst):
-        cmd = "zfs clone {dataset}/{src}@1 {dataset}/{dst}"
-        cmd = cmd.format(dataset=self.dataset, src=src, dst=dst)
+    def clone(self, src, dst, version=1):
+        cmd = "zfs clone {dataset}/{src}@{version} {dataset}/{dst}"
+        cmd = cmd.format(dataset=self.dataset, src=src, dst=dst,
+                         version=version)
         yield from self.ssh.run(cmd)
 
     @asyncio.coroutine
     def exist(self, name):
-        LOG.debug("Checking if image %s exist" % name)
-        cmd = ["zfs", "list", "%s/%s@1" % (self.dataset, name)]
-        return not (yield from self.ssh.run(cmd, check=False, stderr=print))
+        return bool((yield from self.get_versions(name)))
+
+    @asyncio.coroutine
+    def get_versions(self, name):
+        """Return set of snapshot versions of image."""
+        cmd = ["zfs", "list", "-H", "-o", "name", "-t", "snapshot",
+               "-d", "1", "%s/%s" % (self.dataset, name)]
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        prefix = "%s/%s@" % (self.dataset, name)
+        return {int(line[len(prefix):]) for line in data.splitlines()
+                if line.startswith(prefix) and line[len(prefix):].isdigit()}
+
+    @asyncio.coroutine
+    def list_names(self):
+        """Return dict name -> used bytes of all volumes."""
+        cmd = ["zfs", "list", "-Hp", "-o", "name,used", "-d", "1",
+               "-t", "filesystem", self.dataset]
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        names = {}
+        for line in data.splitlines():
+            name, sep, used = line.partition("\t")
+            if name.startswith(self.dataset + "/"):
+                names[name[len(self.dataset) + 1:]] = int(used or 0)
+        return names
+
+    def get_send_cmd(self, name, version, base=None):
+        cmd = ["zfs", "send"]
+        if base:
+            cmd += ["-i", "@%s" % base]
+        return cmd + ["%s/%s@%s" % (self.dataset, name, version)]
+
+    def get_receive_cmd(self, name):
+        return ["zfs", "receive", "-F", "%s/%s" % (self.dataset, name)]
 
     @asyncio.coroutine
     def snapshot(self, name, snapshot="1"):
@@ -81,12 +143,21 @@ class ZFS:
         yield from self.ssh.run(cmd)
 
     @asyncio.coroutine
-    def download(self, name, url):
-        # TODO: cache
-        yield from self.create(name)
-        cmd = "wget -nv {url} -O {path}/{name}/vda.qcow2"
-        cmd = cmd.format(name=name, path=self.path, url=url)
+    def destroy_version(self, name, version):
+        yield from self.destroy("%s@%s" % (name, version))
+
+    @asyncio.coroutine
+    def prepare_refresh(self, name, version):
+        """Make writable image equal to version before refreshing it."""
+        cmd = ["zfs", "rollback", "%s/%s@%s" % (self.dataset, name, version)]
         yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def download(self, name, url, sha256=None, create=True):
+        if create:
+            yield from self.create(name)
+        dst = "{path}/{name}/vda.qcow2".format(name=name, path=self.path)
+        yield from self.cache.fetch(url, dst, sha256)
         cmd = "qemu-img resize {path}/{name}/vda.qcow2 64G"
         cmd = cmd.format(name=name, path=self.path)
         yield from self.ssh.run(cmd)
@@ -94,12 +165,19 @@ class ZFS:
 
 class BTRFS:
 
+    supports_streaming = True
+
     def __init__(self, ssh, path, **kwargs):
         self.ssh = ssh
         self.path = path
+        self.cache = DownloadCache(ssh, kwargs.get("cache-dir",
+                                                   DEFAULT_CACHE_DIR))
 
     @asyncio.coroutine
     def create(self, name):
+        cmd = "btrfs subvolume delete {path}/{name}".format(path=self.path,
+                                                            name=name)
+        yield from self.ssh.run(cmd, check=False)
         cmd = "btrfs subvolume create {path}/{name}".format(path=self.path,
                                                             name=name)
         yield from self.ssh.run(cmd)
@@ -111,25 +189,49 @@ class BTRFS:
         return [os.path.join("/", self.path, name, f) for f in ls.splitlines()]
 
     @asyncio.coroutine
-    def clone(self, src, dst):
+    def clone(self, src, dst, version=1):
         cmd = "btrfs subvolume delete {path}/{dst}"
         cmd = cmd.format(path=self.path, src=src, dst=dst)
         yield from self.ssh.run(cmd, check=False)
-        cmd = "btrfs subvolume snapshot {path}/{src} {path}/{dst}"
-        cmd = cmd.format(path=self.path, src=src, dst=dst)
+        cmd = "btrfs subvolume snapshot {path}/{src}@{version} {path}/{dst}"
+        cmd = cmd.format(path=self.path, src=src, dst=dst, version=version)
         yield from self.ssh.run(cmd)
 
     @asyncio.coroutine
     def exist(self, name):
+        return bool((yield from self.get_versions(name)))
+
+    @asyncio.coroutine
+    def get_versions(self, name):
+        """Return set of read only snapshot versions of image."""
         LOG.debug("Checking if image %s exist" % name)
         cmd = "btrfs subvolume list %s" % self.path
         err, data, err = yield from self.ssh.out(cmd, check=False)
-        r = re.search(" %s$" % name, data, re.MULTILINE)
-        return bool(r)
+        r = re.findall(r"[ /]%s@(\d+)$" % re.escape(name), data, re.MULTILINE)
+        return {int(v) for v in r}
 
     @asyncio.coroutine
-    def snapshot(self, *args, **kwargs):
-        yield from asyncio.sleep(0)
+    def snapshot(self, name, snapshot="1"):
+        cmd = "btrfs subvolume snapshot -r {path}/{name} {path}/{name}@{snap}"
+        cmd = cmd.format(path=self.path, name=name, snap=snapshot)
+        yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def list_names(self):
+        """Return dict name -> used bytes (unknown for btrfs)."""
+        cmd = "btrfs subvolume list -o %s" % self.path
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        return {line.split()[-1].split("/")[-1]: 0
+                for line in data.splitlines() if line.strip()}
+
+    def get_send_cmd(self, name, version, base=None):
+        cmd = ["btrfs", "send"]
+        if base:
+            cmd += ["-p", "%s/%s@%s" % (self.path, name, base)]
+        return cmd + ["%s/%s@%s" % (self.path, name, version)]
+
+    def get_receive_cmd(self, name):
+        return ["btrfs", "receive", self.path]
 
     @asyncio.coroutine
     def destroy(self, name):
@@ -138,19 +240,216 @@ class BTRFS:
         yield from self.ssh.run(cmd)
 
     @asyncio.coroutine
-    def download(self, name, url):
-        # TODO: cache
-        yield from self.create(name)
-        cmd = "wget -nv {url} -O /{path}/{name}/vda.qcow2"
-        cmd = cmd.format(name=name, path=self.path, url=url)
-        yield from self.ssh.run(cmd)
+    def destroy_version(self, name, version):
+        yield from self.destroy("%s@%s" % (name, version))
+
+    @asyncio.coroutine
+    def prepare_refresh(self, name, version):
+        """Make writable image equal to version before refreshing it."""
+        yield from self.clone(name, name, version)
+
+    @asyncio.coroutine
+    def download(self, name, url, sha256=None, create=True):
+        if create:
+            yield from self.create(name)
+        dst = "/{path}/{name}/vda.qcow2".format(name=name, path=self.path)
+        yield from self.cache.fetch(url, dst, sha256)
         # TODO: size should be set in config
         cmd = "qemu-img resize /{path}/{name}/vda.qcow2 64G"
         cmd = cmd.format(name=name, path=self.path)
         yield from self.ssh.run(cmd)
 
 
-BACKENDS = {"btrfs": BTRFS, "zfs": ZFS}
+class LVM:
+    """LVM thin volumes.
+
+    Image versions are thin snapshots <name>.v<N>, VM disks are thin
+    snapshots of versions. Volumes contain raw disk images.
+    """
+
+    supports_streaming = False
+
+    def __init__(self, ssh, vg, pool, size="64G", **kwargs):
+        self.ssh = ssh
+        self.vg = vg
+        self.pool = pool
+        self.size = size
+        self.cache = DownloadCache(ssh, kwargs.get("cache-dir",
+                                                   DEFAULT_CACHE_DIR))
+
+    def _version(self, name, version):
+        return "%s.v%s" % (name, version)
+
+    @asyncio.coroutine
+    def create(self, name):
+        cmd = ["lvcreate", "-V", self.size, "-T",
+               "%s/%s" % (self.vg, self.pool), "-n", name]
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def list_files(self, name):
+        yield from asyncio.sleep(0)
+        return ["/dev/%s/%s" % (self.vg, name)]
+
+    @asyncio.coroutine
+    def clone(self, src, dst, version=1):
+        cmd = ["lvcreate", "-s", "-kn", "-n", dst,
+               "%s/%s" % (self.vg, self._version(src, version))]
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def exist(self, name):
+        return bool((yield from self.get_versions(name)))
+
+    @asyncio.coroutine
+    def get_versions(self, name):
+        cmd = ["lvs", "--noheadings", "-o", "lv_name", self.vg]
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        r = re.findall(r"^\s*%s\.v(\d+)\s*$" % re.escape(name), data,
+                       re.MULTILINE)
+        return {int(v) for v in r}
+
+    @asyncio.coroutine
+    def snapshot(self, name, snapshot="1"):
+        cmd = ["lvcreate", "-s", "-n", self._version(name, snapshot),
+               "%s/%s" % (self.vg, name)]
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def destroy(self, name):
+        cmd = ["lvremove", "-f", "%s/%s" % (self.vg, name)]
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def destroy_version(self, name, version):
+        yield from self.destroy(self._version(name, version))
+
+    @asyncio.coroutine
+    def prepare_refresh(self, name, version):
+        """Make writable image equal to version before refreshing it."""
+        cmd = ["lvremove", "-f", "%s/%s" % (self.vg, name)]
+        yield from self.ssh.run(cmd, check=False)
+        yield from self.clone(name, name, version)
+
+    @asyncio.coroutine
+    def download(self, name, url, sha256=None, create=True):
+        if create:
+            yield from self.create(name)
+        tmp = "/var/tmp/rci-%s.qcow2" % name
+        yield from self.cache.fetch(url, tmp, sha256)
+        cmd = "qemu-img convert -O raw {tmp} /dev/{vg}/{name}; rm -f {tmp}"
+        cmd = cmd.format(tmp=tmp, vg=self.vg, name=name)
+        yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def list_names(self):
+        """Return dict name -> used bytes of all volumes in vg."""
+        cmd = ["lvs", "--noheadings", "--units", "b", "--nosuffix",
+               "-o", "lv_name,lv_size,data_percent", self.vg]
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        names = {}
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) == 3:
+                names[fields[0]] = int(float(fields[1]) *
+                                       float(fields[2]) / 100)
+            elif fields:
+                names[fields[0]] = 0
+        return names
+
+
+class QCOW2:
+    """qcow2 files on any filesystem.
+
+    Image versions are standalone copies in <path>/<name>@<N>/, VM disks
+    are overlay files with backing file in the version directory.
+    """
+
+    supports_streaming = False
+
+    def __init__(self, ssh, path, **kwargs):
+        self.ssh = ssh
+        self.path = path
+        self.cache = DownloadCache(ssh, kwargs.get("cache-dir",
+                                                   DEFAULT_CACHE_DIR))
+
+    @asyncio.coroutine
+    def create(self, name):
+        cmd = ["mkdir", "-p", "%s/%s" % (self.path, name)]
+        yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def list_files(self, name):
+        cmd = "ls {path}/{name}".format(path=self.path, name=name)
+        err, ls, err = yield from self.ssh.out(cmd)
+        return [os.path.join(self.path, name, f) for f in ls.splitlines()]
+
+    @asyncio.coroutine
+    def clone(self, src, dst, version=1):
+        cmd = ("mkdir {path}/{dst} && cd {path}/{src}@{version} && "
+               "for f in *; do qemu-img create -q -f qcow2 -F qcow2 "
+               "-b {path}/{src}@{version}/$f {path}/{dst}/$f; done")
+        cmd = cmd.format(path=self.path, src=src, dst=dst, version=version)
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def exist(self, name):
+        return bool((yield from self.get_versions(name)))
+
+    @asyncio.coroutine
+    def get_versions(self, name):
+        cmd = "ls -d {path}/{name}@*".format(path=self.path, name=name)
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        r = re.findall(r"/%s@(\d+)$" % re.escape(name), data, re.MULTILINE)
+        return {int(v) for v in r}
+
+    @asyncio.coroutine
+    def snapshot(self, name, snapshot="1"):
+        cmd = ("mkdir {path}/{name}@{snap} && cd {path}/{name} && "
+               "for f in *; do qemu-img convert -O qcow2 $f "
+               "{path}/{name}@{snap}/$f; done && "
+               "chmod a-w {path}/{name}@{snap}/*")
+        cmd = cmd.format(path=self.path, name=name, snap=snapshot)
+        yield from self.ssh.run(cmd, stderr=LOG.warning)
+
+    @asyncio.coroutine
+    def destroy(self, name):
+        cmd = ["rm", "-rf", "%s/%s" % (self.path, name)]
+        yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def destroy_version(self, name, version):
+        yield from self.destroy("%s@%s" % (name, version))
+
+    @asyncio.coroutine
+    def prepare_refresh(self, name, version):
+        """Make writable image equal to version before refreshing it."""
+        yield from self.destroy(name)
+        yield from self.clone(name, name, version)
+
+    @asyncio.coroutine
+    def download(self, name, url, sha256=None, create=True):
+        if create:
+            yield from self.create(name)
+        dst = "{path}/{name}/vda.qcow2".format(name=name, path=self.path)
+        yield from self.cache.fetch(url, dst, sha256)
+        cmd = "qemu-img resize {path}/{name}/vda.qcow2 64G"
+        cmd = cmd.format(name=name, path=self.path)
+        yield from self.ssh.run(cmd)
+
+    @asyncio.coroutine
+    def list_names(self):
+        """Return dict name -> used bytes of all images and disks."""
+        cmd = "du -s -B1 {path}/*".format(path=self.path)
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        names = {}
+        for line in data.splitlines():
+            used, sep, path = line.partition("\t")
+            names[path.split("/")[-1]] = int(used)
+        return names
+
+
+BACKENDS = {"btrfs": BTRFS, "zfs": ZFS, "lvm": LVM, "qcow2": QCOW2}
 
 
 class Host:
@@ -166,28 +465,94 @@ class Host:
         self.config = provider.config
 
         self.image_locks = {}
+        self.image_versions = {}
+        self.image_built_at = {}
+        self._image_users = collections.Counter()
         self._job_vms = {}
         self._job_bridge_numbers = {}
+        self._job_bridge_locks = {}
         ssh_conf.setdefault("username", "root")
         ssh_conf["keys"] = root.config.get_ssh_keys(keytype="private")
-        self.ssh = SSH(root.loop, **ssh_conf)
+        self.ssh = root.ssh_pool.get(**ssh_conf)
         self.la = 0.0
         self.free = 0
+        self.total = 0
+        self.nproc = 0
+        self.stats_updated_at = 0
+        self._reservations = {}
+        self._pools = collections.defaultdict(list)
+        self._pool_filling = collections.Counter()
+        self._pool_requests = collections.defaultdict(collections.deque)
+        self._boot_times = {}
         storage_cf = self.config["storage"]
         self.storage = BACKENDS[storage_cf["backend"]](self.ssh, **storage_cf)
         self.bridge_lock = asyncio.Lock(loop=root.loop)
+        self._bridges = None
+        self._owned = set()
+        self.ready = False
+        self.events_running = False
+        self.events_future = None
+        self._stop_waiters = collections.defaultdict(list)
+        self._domain_watchers = {}
+        self.ip_watcher = watcher.Watcher(root.loop, self._get_neighbours,
+                                          self.config.get("ip-poll-interval",
+                                                          2))
 
     def __str__(self):
-        return "<Host %s (la: %s, free: %s)>" % (self.ssh.hostname,
-                                                 self.la, self.free)
+        return "<Host %s (la: %s, free: %s, reserved: %s)>" % (
+            self.ssh.hostname, self.la, self.free,
+            sum(r[0] for r in self._reservations.values()))
+
+    @asyncio.coroutine
+    def _get_neighbours(self):
+        """Return mac -> ip for all VMs seen on this host."""
+        cmd = ["cat", "/proc/net/arp"] + self.config.get("leases-files", [])
+        err, data, err = yield from self.ssh.out(cmd, check=False)
+        return parse_neighbours(data)
 
     @asyncio.coroutine
     def update_stats(self):
-        cmd = "uptime && free -m"
+        cmd = "uptime && free -m && nproc"
         err, data, err = yield from self.ssh.out(cmd)
         self.la = float(RE_LA.search(data, re.MULTILINE).group(1))
-        free = RE_MEM.search(data, re.MULTILINE).groups()
-        self.free = sum(map(int, free))
+        mem = RE_MEM.search(data, re.MULTILINE).groups()
+        self.total = int(mem[0])
+        self.free = int(mem[1]) + int(mem[2])
+        nproc = RE_NPROC.search(data)
+        if nproc:
+            self.nproc = int(nproc.group(1))
+        self.stats_updated_at = time.time()
+
+    def reserve(self, key, memory, vcpus):
+        """Reserve resources for VMs which are not booted yet.
+
+        :param key: owner of reservation (e.g. job)
+        :param int memory: MiB
+        :param int vcpus:
+        """
+        self._reservations[key] = (memory, vcpus, time.time())
+
+    def release(self, key):
+        self._reservations.pop(key, None)
+
+    def get_free_resources(self):
+        """Return (memory, vcpus) available for new VMs.
+
+        Reservations younger than reservation-settle seconds at the time
+        of last stats update are not reflected by "free" yet and are
+        subtracted from it. All reservations are subtracted from total
+        memory, so the result never exceeds it.
+        """
+        settle = self.config.get("reservation-settle", 300)
+        memory = vcpus = recent = 0
+        for r_memory, r_vcpus, reserved_at in self._reservations.values():
+            memory += r_memory
+            vcpus += r_vcpus
+            if self.stats_updated_at - reserved_at < settle:
+                recent += r_memory
+        free_memory = min(self.free - recent, self.total - memory)
+        free_vcpus = self.nproc * self.config.get("cpu-overcommit", 4) - vcpus
+        return free_memory, free_vcpus
 
     @asyncio.coroutine
     def boot_image(self, name):
@@ -211,90 +576,359 @@ class Host:
         yield from ssh.run(cmd, stdin=script["data"],
                            stderr=LOG.debug)
 
+    def get_image_lock(self, name):
+        lock = self.image_locks.get(name)
+        if lock is None:
+            lock = self.image_locks[name] = asyncio.Lock(loop=self.root.loop)
+        return lock
+
+    @asyncio.coroutine
+    def get_image_versions(self, name):
+        """Return set of image versions present on this host."""
+        versions = self.image_versions.get(name)
+        if versions is None:
+            versions = yield from self.storage.get_versions(name)
+            self.image_versions[name] = versions
+            if versions:
+                # real build time is unknown, count ttl from now
+                self.image_built_at.setdefault(name, time.time())
+        return versions
+
     @asyncio.coroutine
     def build_image(self, name):
-        LOG.info("Building image %s" % name)
-        self.image_locks.setdefault(name, asyncio.Lock(loop=self.root.loop))
-        with (yield from self.image_locks[name]):
-            if (yield from self.storage.exist(name)):
+        """Make image available on this host.
+
+        :returns: version of image to clone VMs from
+        """
+        if self.config.get("image-distribution") == "stream":
+            return (yield from self.provider.distribute_image(self, name))
+        return (yield from self._build_image(name))
+
+    @asyncio.coroutine
+    def _build_image(self, name, version=1):
+        versions = self.image_versions.get(name)
+        if versions:
+            return max(versions)
+        with (yield from self.get_image_lock(name)):
+            versions = yield from self.get_image_versions(name)
+            if versions:
                 LOG.debug("Image %s exist" % name)
-                return
+                return max(versions)
+            LOG.info("Building image %s" % name)
             image_conf = self.config["images"][name]
             parent = image_conf.get("parent")
             if parent:
-                yield from self.build_image(parent)
-                yield from self.storage.clone(parent, name)
+                parent_version = yield from self.build_image(parent)
+                yield from self.storage.clone(parent, name, parent_version)
             else:
                 url = image_conf.get("url")
                 if url:
-                    yield from self.storage.download(name, url)
-                    yield from self.storage.snapshot(name)
-                    return  # TODO: support build_script for downloaded images
-            build_scripts = image_conf.get("build-scripts")
-            if build_scripts:
-                vm = yield from self.boot_image(name)
-                try:
-                    for script in build_scripts:
-                        script = self.root.config.data["script"][script]
-                        LOG.debug("Running build script %s" % script)
-                        yield from self._run_script(vm, script)
-                    yield from vm.shutdown(storage=False)
-                except:
-                    LOG.exception("Error building image")
-                    yield from vm.destroy()
-                    raise
+                    yield from self.storage.download(
+                        name, url, image_conf.get("sha256"))
+                    yield from self.storage.snapshot(name, str(version))
+                    versions.add(version)
+                    self.image_built_at[name] = time.time()
+                    # TODO: support build_script for downloaded images
+                    return version
+            yield from self._run_build_scripts(
+                name, image_conf.get("build-scripts"))
+            yield from self.storage.snapshot(name, str(version))
+            versions.add(version)
+            self.image_built_at[name] = time.time()
+            return version
+
+    @asyncio.coroutine
+    def _run_build_scripts(self, name, build_scripts):
+        if build_scripts:
+            vm = yield from self.boot_image(name)
+            try:
+                for script in build_scripts:
+                    script = self.root.config.data["script"][script]
+                    LOG.debug("Running build script %s" % script)
+                    yield from self._run_script(vm, script)
+                yield from vm.shutdown(storage=False)
+            except:
+                LOG.exception("Error building image")
+                yield from vm.destroy()
+                raise
+        else:
+            LOG.debug("No build script for image %s" % name)
+
+    def image_expired(self, name):
+        ttl = self.config["images"][name].get("ttl")
+        built_at = self.image_built_at.get(name)
+        return bool(ttl and built_at and time.time() - built_at > ttl)
+
+    @asyncio.coroutine
+    def refresh_image(self, name, version=None):
+        """Build next version of image in place.
+
+        Image is updated by running refresh-scripts (build-scripts by
+        default) or by downloading it again. New clones use new version
+        as soon as it is snapshotted, VMs cloned from older versions keep
+        running and old versions are destroyed when not used anymore.
+
+        :param int version: version to build (next to latest by default)
+        :returns: new version
+        """
+        with (yield from self.get_image_lock(name)):
+            versions = yield from self.get_image_versions(name)
+            latest = max(versions)
+            if version is None:
+                version = latest + 1
+            LOG.info("Refreshing image %s@%s on %s" % (name, version, self))
+            image_conf = self.config["images"][name]
+            yield from self.storage.prepare_refresh(name, latest)
+            url = image_conf.get("url")
+            if url and not image_conf.get("parent"):
+                yield from self.storage.download(
+                    name, url, image_conf.get("sha256"), create=False)
             else:
-                LOG.debug("No build script for image %s" % name)
-            yield from asyncio.sleep(4)
-            yield from self.storage.snapshot(name)
+                yield from self._run_build_scripts(
+                    name, image_conf.get("refresh-scripts",
+                                         image_conf.get("build-scripts")))
+            yield from self.storage.snapshot(name, str(version))
+            versions.add(version)
+            self.image_built_at[name] = time.time()
+        return version
+
+    def use_image(self, name, version):
+        self._image_users[(name, version)] += 1
+
+    @asyncio.coroutine
+    def release_image(self, name, version):
+        self._image_users[(name, version)] -= 1
+        if self._image_users[(name, version)] <= 0:
+            del self._image_users[(name, version)]
+            yield from self.gc_image(name)
+
+    @asyncio.coroutine
+    def gc_image(self, name):
+        """Destroy versions of image which are not latest and not used."""
+        versions = self.image_versions.get(name)
+        if not versions:
+            return
+        latest = max(versions)
+        for version in sorted(versions):
+            if version == latest or self._image_users[(name, version)]:
+                continue
+            LOG.info("Destroying unused image %s@%s on %s" % (name, version,
+                                                              self))
+            try:
+                yield from self.storage.destroy_version(name, version)
+            except Exception:
+                # e.g. snapshot has dependent clones (child images)
+                LOG.debug("Unable to destroy %s@%s" % (name, version))
+                continue
+            versions.discard(version)
+
+    @asyncio.coroutine
+    def receive_image(self, source, name, version, base=None):
+        """Stream image version from another host.
+
+        :param Host source: host having the version
+        :param base: version present on both hosts (incremental send)
+        """
+        LOG.info("Streaming image %s@%s from %s to %s (base: %s)" % (
+            name, version, source, self, base))
+        send_cmd = source.storage.get_send_cmd(name, version, base)
+        receive_cmd = self.storage.get_receive_cmd(name)
+        yield from pipe(source.ssh, send_cmd, self.ssh, receive_cmd,
+                        self.root.loop)
+        self.image_versions.setdefault(name, set()).add(version)
 
     @asyncio.coroutine
     def _get_vm(self, name, conf):
         """
         :param conf: config.provider.vms item
         """
+        try:
+            return (yield from self._create_vm(name, conf))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            image = conf.get("image")
+            if not (image and (yield from self._image_lost(image))):
+                raise
+        return (yield from self._create_vm(name, conf))
+
+    @asyncio.coroutine
+    def _image_lost(self, name):
+        """Check if cached image versions are still present in storage.
+
+        Versions are cached, so image deleted by hand is noticed only when
+        cloning it fails. Cache is updated, so image is built again on
+        next use.
+        """
+        cached = self.image_versions.pop(name, None)
+        versions = yield from self.get_image_versions(name)
+        if cached and not cached <= versions:
+            LOG.warning("Image %s versions %s disappeared from %s" % (
+                name, sorted(cached - versions), self))
+            self.provider.image_registry.pop(name, None)
+            return True
+        return False
+
+    @asyncio.coroutine
+    def _create_vm(self, name, conf):
         LOG.debug("Creating VM %s" % name)
         image = conf.get("image")
+        version = 1
         if image:
-            yield from self.build_image(image)
+            version = yield from self.build_image(image)
         else:
             image = name
         rnd_name = utils.get_rnd_name("rci_" + name)
-        yield from self.storage.clone(image, rnd_name)
+        self.use_image(image, version)
+        self._owned.add(rnd_name)
         vm = VM(self, name, conf)
-        files = yield from self.storage.list_files(rnd_name)
+        try:
+            yield from self.storage.clone(image, rnd_name, version)
+            files = yield from self.storage.list_files(rnd_name)
+            for f in files:
+                vm.add_disk(f)
+            for net in conf["net"]:
+                net = net.split(" ")
+                if len(net) == 1:
+                    vm.add_net(net[0])
+                else:
+                    vm.add_net(net[0], mac=net[1])
+            yield from vm.boot()
+        except BaseException:
+            # vm is not returned to job, so nobody else will destroy it
+            LOG.info("Destroying unfinished %s on %s" % (vm, self))
+            yield from self.ssh.run(["virsh", "destroy", vm.name],
+                                    check=False)
+            try:
+                yield from self.storage.destroy(rnd_name)
+            except Exception:
+                LOG.exception("Unable to destroy %s on %s" % (rnd_name, self))
+            self._owned.discard(vm.name)
+            self._owned.discard(rnd_name)
+            yield from self.release_image(image, version)
+            raise
+        vm.image = (image, version)
         vm.disks.append(rnd_name)
-        for f in files:
-            vm.add_disk(f)
-        for net in conf["net"]:
-            net = net.split(" ")
-            if len(net) == 1:
-                vm.add_net(net[0])
-            else:
-                vm.add_net(net[0], mac=net[1])
-        yield from vm.boot()
         return vm
 
+    def _get_vm_conf(self, name):
+        conf = copy.deepcopy(self.config["vms"][name])
+        if "net" not in conf:
+            conf["net"] = ["virbr0"]
+        return conf
+
+    def _get_pool_size(self, name):
+        """Return desired number of ready VMs in warm pool.
+
+        Size is number of VMs expected to be requested while one VM is
+        being booted, limited by min and max from warm-pool config.
+        """
+        pool_conf = self.config.get("warm-pool", {}).get(name)
+        if not pool_conf:
+            return 0
+        window = pool_conf.get("window", 600)
+        requests = self._pool_requests[name]
+        while requests and requests[0] < time.time() - window:
+            requests.popleft()
+        rate = len(requests) / window
+        size = math.ceil(rate * self._boot_times.get(name, 0))
+        return max(pool_conf.get("min", 1),
+                   min(pool_conf.get("max", 4), size))
+
+    def start_pools(self):
+        for name in self.config.get("warm-pool", {}):
+            if any(n.split(" ")[0].endswith("%")
+                   for n in self._get_vm_conf(name)["net"]):
+                LOG.warning("VM %s uses per job networks and can't be "
+                            "pooled" % name)
+                continue
+            self.root.start_coro(self._fill_pool(name))
+
+    @asyncio.coroutine
+    def _fill_pool(self, name):
+        while (len(self._pools[name]) + self._pool_filling[name] <
+               self._get_pool_size(name)):
+            self._pool_filling[name] += 1
+            conf = self._get_vm_conf(name)
+            started_at = time.time()
+            # name of VM is not known until it is created
+            key = object()
+            self.reserve(key, conf.get("memory", 1024), conf.get("vcpu", 1))
+            try:
+                vm = yield from self._get_vm(name, conf)
+                try:
+                    yield from vm.get_ssh()
+                except Exception:
+                    yield from vm.destroy()
+                    raise
+            except Exception:
+                LOG.exception("Error booting VM %s for pool" % name)
+                self.release(key)
+                return
+            finally:
+                self._pool_filling[name] -= 1
+            boot_time = time.time() - started_at
+            self._boot_times[name] = (self._boot_times.get(name, boot_time) +
+                                      boot_time) / 2
+            self._reservations[vm.name] = self._reservations.pop(key)
+            self._pools[name].append(vm)
+            self.watch_domain(vm.name, functools.partial(
+                self._pooled_vm_died, name, vm))
+            LOG.debug("VM %s added to pool (%.1fs)" % (vm, boot_time))
+
+    def _pooled_vm_died(self, name, vm, reason):
+        """Drop VM which stopped while waiting in pool.
+
+        It is dropped immediately, so it is never given to a job.
+        """
+        LOG.warning("Pooled VM %s died (%s)" % (vm, reason))
+        pool = self._pools[name]
+        if vm in pool:
+            pool.remove(vm)
+            self.release(vm.name)
+            self.root.start_coro(vm.destroy())
+            self.root.start_coro(self._fill_pool(name))
+
+    def _get_pooled_vm(self, name):
+        self._pool_requests[name].append(time.time())
+        pool = self._pools.get(name)
+        if pool:
+            vm = pool.pop(0)
+            self.release(vm.name)
+            self.root.start_coro(self._fill_pool(name))
+            return vm
+        if name in self.config.get("warm-pool", {}):
+            self.root.start_coro(self._fill_pool(name))
+
+    def has_pooled_vm(self, names):
+        return any(self._pools.get(name) for name in names)
+
+    @asyncio.coroutine
+    def stop_pools(self):
+        for pool in self._pools.values():
+            while pool:
+                vm = pool.pop()
+                self.release(vm.name)
+                self._domain_watchers.pop(vm.name, None)
+                yield from vm.destroy()
+
     @asyncio.coroutine
     def get_vm_for_job(self, name, job):
         """
         :param str name: vm name
         :param Job job:
         """
-        conf = copy.deepcopy(self.config["vms"][name])
-        if "net" not in conf:
-            conf["net"] = ["virbr0"]
+        conf = self._get_vm_conf(name)
+        vm = self._get_pooled_vm(name)
+        if vm:
+            LOG.debug("Using VM %s from pool for %s" % (vm, job))
+            self._job_vms.setdefault(job, []).append(vm)
+            self.watch_domain(vm.name, functools.partial(job.vm_died, vm))
+            return vm
         for i, net in enumerate(conf["net"]):
             ifname = net.split(" ")
             if ifname[0].endswith("%"):
-                _br = self._job_bridge_numbers.get(job, {})
-                brname = _br.get(ifname[0])
-                LOG.debug("Got %s for %s (%s)" % (brname, job, self))
-                if not brname:
-                    brname = yield from self._get_bridge(ifname[0][:-1])
-                    self._job_bridge_numbers.setdefault(job, {})
-                    self._job_bridge_numbers[job][ifname[0]] = brname
-                    LOG.debug("Created %s for %s (%s)" % (brname, job, self))
+                brname = yield from self._get_job_bridge(job, ifname[0])
                 new = conf["net"][i].replace(ifname[0], brname)
                 conf["net"][i] = new
 
@@ -302,33 +936,244 @@ class Host:
         if job not in self._job_vms:
             self._job_vms[job] = []
         self._job_vms[job].append(vm)
+        self.watch_domain(vm.name, functools.partial(job.vm_died, vm))
         return vm
 
     @asyncio.coroutine
     def cleanup(self, job):
+        self.release(job)
         for vm in self._job_vms.pop(job, []):
+            self._domain_watchers.pop(vm.name, None)
             yield from vm.destroy()
-        with (yield from self.bridge_lock):
-            self._job_bridge_numbers.pop(job, None)
+        bridges = self._job_bridge_numbers.pop(job, {})
+        self._job_bridge_locks.pop(job, None)
+        if bridges:
+            yield from self._delete_bridges(bridges.values())
 
     @asyncio.coroutine
-    def _get_bridge(self, prefix):
+    def _get_job_bridge(self, job, ifname):
+        """Return bridge shared by all VMs of job.
+
+        VMs of one job are provisioned concurrently, so bridge is created
+        under per job lock.
+        """
+        lock = self._job_bridge_locks.setdefault(
+            job, asyncio.Lock(loop=self.root.loop))
+        with (yield from lock):
+            _br = self._job_bridge_numbers.setdefault(job, {})
+            brname = _br.get(ifname)
+            LOG.debug("Got %s for %s (%s)" % (brname, job, self))
+            if not brname:
+                brname = yield from self._get_bridge(ifname[:-1])
+                _br[ifname] = brname
+                LOG.debug("Created %s for %s (%s)" % (brname, job, self))
+        return brname
+
+    @asyncio.coroutine
+    def bootstrap(self, mds_addr, mds_port):
+        """Prepare host for running jobs.
+
+        :param str mds_addr: metadata server address (0.0.0.0 for any)
+        :param int mds_port: metadata server port
+        """
+        if self.events_future is None or self.events_future.done():
+            self.start_events()
+        yield from self.reconcile_bridges()
+        if mds_addr == "0.0.0.0":
+            mds_addr = yield from self.root.loop.run_in_executor(
+                None, utils.get_local_address, self.ssh.hostname)
+        rule = ("PREROUTING -d 169.254.169.254 -p tcp --dport 80 "
+                "-j DNAT --to-destination %s:%s") % (mds_addr, mds_port)
+        yield from self.ssh.run(("iptables -t nat -C %s ||"
+                                 "iptables -t nat -I %s") % (rule, rule))
+        self.ready = True
+
+    def start_events(self):
+        self.events_future = asyncio.async(self._listen_events(),
+                                           loop=self.root.loop)
+
+    @asyncio.coroutine
+    def _listen_events(self):
+        """Follow libvirt lifecycle events of all domains on host."""
+        cmd = "virsh event --event lifecycle --loop"
+        while True:
+            framer = utils.LineFramer()
+
+            def cb(data):
+                for line in framer.feed(data):
+                    self._handle_event(line.decode("utf-8", "replace"))
+
+            self.events_running = True
+            try:
+                yield from self.ssh.run(cmd, stdout=cb, stderr=LOG.warning,
+                                        check=False)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOG.exception("Error listening events on %s" % self)
+            finally:
+                self.events_running = False
+            yield from asyncio.sleep(10, loop=self.root.loop)
+
+    def _handle_event(self, line):
+        m = RE_EVENT.match(line)
+        if not m:
+            return
+        name, event, detail = m.groups()
+        if event not in ("Stopped", "Crashed"):
+            return
+        LOG.debug("Domain %s %s (%s)" % (name, event, detail))
+        for fut in self._stop_waiters.pop(name, []):
+            if not fut.done():
+                fut.set_result(detail)
+        cb = self._domain_watchers.pop(name, None)
+        if cb:
+            cb("%s %s" % (event, detail))
+
+    def domain_stopped(self, name):
+        """Return future resolved when domain is stopped.
+
+        Should be called before stopping domain to not miss the event.
+        """
+        fut = asyncio.Future(loop=self.root.loop)
+        self._stop_waiters[name].append(fut)
+        return fut
+
+    def watch_domain(self, name, cb):
+        """Call cb(reason) if domain is stopped or crashed.
+
+        Watcher is removed before domain is destroyed by cleanup.
+        """
+        self._domain_watchers[name] = cb
+
+    def _get_bridge_prefixes(self):
+        prefixes = set()
+        for vm_conf in self.config.get("vms", {}).values():
+            for net in vm_conf.get("net", []):
+                ifname = net.split(" ")[0]
+                if ifname.endswith("%"):
+                    prefixes.add(ifname[:-1])
+        return prefixes
+
+    @asyncio.coroutine
+    def _reap_domain(self, name):
+        cmd = "virsh dominfo {name} | grep 'Used memory'; virsh destroy {name}"
+        err, data, err = yield from self.ssh.out(cmd.format(name=name),
+                                                 check=False)
+        m = re.search(r"(\d+) KiB", data)
+        return int(m.group(1)) // 1024 if m else 0
+
+    @asyncio.coroutine
+    def _reap_volume(self, name):
+        yield from self.storage.destroy(name)
+
+    @asyncio.coroutine
+    def reap_orphans(self):
+        """Destroy domains, volumes and job bridges left by crashed daemon.
+
+        Only resources named rci_* (and bridges with prefixes of job
+        networks) which are not owned by this host are destroyed.
+
+        :returns: Counter of reclaimed domains, memory (MiB), volumes,
+            disk (bytes) and bridges
+        """
+        report = collections.Counter()
+        loop = self.root.loop
+        err, data, err = yield from self.ssh.out(["virsh", "list", "--name"],
+                                                 check=False)
+        domains = [name for name in data.split()
+                   if name.startswith("rci_") and name not in self._owned]
+        results = yield from asyncio.gather(
+            *[self._reap_domain(name) for name in domains],
+            return_exceptions=True, loop=loop)
+        for name, result in zip(domains, results):
+            if isinstance(result, Exception):
+                LOG.warning("Unable to destroy %s: %r" % (name, result))
+                continue
+            report["domains"] += 1
+            report["memory"] += result
+
+        volumes = yield from self.storage.list_names()
+        volumes = {name: used for name, used in volumes.items()
+                   if name.startswith("rci_") and name not in self._owned}
+        names = list(volumes)
+        results = yield from asyncio.gather(
+            *[self._reap_volume(name) for name in names],
+            return_exceptions=True, loop=loop)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                LOG.warning("Unable to destroy %s: %r" % (name, result))
+                continue
+            report["volumes"] += 1
+            report["disk"] += volumes[name]
+
+        yield from self.reconcile_bridges()
+        bridges = ["%s%d" % (prefix, num)
+                   for prefix in self._get_bridge_prefixes()
+                   for num in self._bridges.get(prefix, ())]
+        bridges = [br for br in bridges if br not in self._owned]
+        if bridges:
+            # delete only bridges without attached interfaces
+            cmd = ("for b in %s; do [ -z \"$(ls /sys/class/net/$b/brif)\" ] "
+                   "&& ip link del $b && echo $b; done" % " ".join(bridges))
+            err, data, err = yield from self.ssh.out(cmd, check=False)
+            for br in data.split():
+                self._free_bridge(br)
+                report["bridges"] += 1
+        return report
+
+    @asyncio.coroutine
+    def reconcile_bridges(self):
+        """Load numbers of existing bridges.
+
+        Done once, after that bridge numbers are allocated in memory.
+        """
         with (yield from self.bridge_lock):
+            if self._bridges is not None:
+                return
             err, data, err = yield from self.ssh.out(["ip", "link", "list"])
-            nums = set()
+            bridges = collections.defaultdict(set)
             for line in data.splitlines():
                 m = IFACE_RE.match(line)
                 if m:
-                    if m.group(1) == prefix:
-                        nums.add(int(m.group(2)))
-            for i in range(len(nums) + 1):
-                if i not in nums:
-                    br = "%s%d" % (prefix, i)
-                    break
-            yield from self.ssh.run(["ip", "link", "add", br,
-                                     "type", "bridge"])
-            yield from self.ssh.run(["ip", "link", "set", br, "up"])
-        return br
+                    bridges[m.group(1)].add(int(m.group(2)))
+            self._bridges = bridges
+
+    def _allocate_bridge(self, prefix):
+        used = self._bridges[prefix]
+        num = 0
+        while num in used:
+            num += 1
+        used.add(num)
+        return "%s%d" % (prefix, num)
+
+    def _free_bridge(self, brname):
+        m = IFACE_RE.match("0: %s: " % brname)
+        if m and self._bridges is not None:
+            self._bridges[m.group(1)].discard(int(m.group(2)))
+
+    @asyncio.coroutine
+    def _get_bridge(self, prefix):
+        yield from self.reconcile_bridges()
+        for attempt in range(3):
+            br = self._allocate_bridge(prefix)
+            self._owned.add(br)
+            cmd = "ip link add {br} type bridge && ip link set {br} up"
+            status = yield from self.ssh.run(cmd.format(br=br), check=False,
+                                             stderr=LOG.warning)
+            if not status:
+                return br
+            # bridge is created by somebody else, keep it marked as used
+            LOG.warning("Unable to create bridge %s on %s" % (br, self))
+        raise Exception("Unable to create bridge %s* on %s" % (prefix, self))
+
+    @asyncio.coroutine
+    def _delete_bridges(self, bridges):
+        cmd = "; ".join("ip link del %s" % br for br in bridges)
+        yield from self.ssh.run(cmd, check=False, stderr=LOG.warning)
+        for br in bridges:
+            self._free_bridge(br)
+            self._owned.discard(br)
 
 
 class Provider:
@@ -341,13 +1186,115 @@ class Provider:
         self.config = config
 
         self.name = config["name"]
+        if config.get("image-distribution") == "stream":
+            backend = config["storage"]["backend"]
+            if not BACKENDS[backend].supports_streaming:
+                raise ValueError("image-distribution: stream is not "
+                                 "supported by %s storage backend" % backend)
         self.key = root.config.get_ssh_key()
-        self.last = time.time()
         self._job_host_map = {}
         self._get_host_lock = asyncio.Lock(loop=root.loop)
+        self.stats_interval = config.get("stats-interval", 10)
+        self.image_registry = {}
+        self._image_locks = {}
+        self.hosts = []
+        self.bootstrap_futures = []
+        self.mds_future = None
+        self.stats_future = None
+        self.refresh_future = None
+        self.sweep_future = None
 
     def get_stats(self):
-        pass
+        return {"hosts": len(self.hosts),
+                "hosts-ready": len([h for h in self.hosts if h.ready])}
+
+    @asyncio.coroutine
+    def update_stats(self):
+        """Poll all hosts concurrently."""
+        futs = [asyncio.wait_for(host.update_stats(), self.stats_interval,
+                                 loop=self.root.loop)
+                for host in self.hosts]
+        results = yield from asyncio.gather(*futs, return_exceptions=True,
+                                            loop=self.root.loop)
+        for host, result in zip(self.hosts, results):
+            if isinstance(result, Exception):
+                LOG.warning("Unable to update stats of %s: %r" % (host,
+                                                                  result))
+
+    @asyncio.coroutine
+    def reap_orphans(self):
+        """Destroy resources leaked on all hosts and log what was reclaimed."""
+        hosts = [host for host in self.hosts if host.ready]
+        results = yield from asyncio.gather(
+            *[host.reap_orphans() for host in hosts],
+            return_exceptions=True, loop=self.root.loop)
+        total = collections.Counter()
+        for host, result in zip(hosts, results):
+            if isinstance(result, Exception):
+                LOG.warning("Unable to reap orphans on %s: %r" % (host,
+                                                                  result))
+                continue
+            if any(result.values()):
+                LOG.info("Reaped orphans on %s: %d domains (%d MiB), "
+                         "%d volumes (%d MiB), %d bridges" % (
+                             host, result["domains"], result["memory"],
+                             result["volumes"], result["disk"] // 2 ** 20,
+                             result["bridges"]))
+            total.update(result)
+        self.root.stats["orphans-reaped"] += (total["domains"] +
+                                              total["volumes"] +
+                                              total["bridges"])
+        return total
+
+    @asyncio.coroutine
+    def _sweep_orphans(self):
+        while True:
+            yield from asyncio.sleep(self.config.get("orphan-sweep-interval",
+                                                     600),
+                                     loop=self.root.loop)
+            yield from self.reap_orphans()
+
+    @asyncio.coroutine
+    def _collect_stats(self):
+        while True:
+            yield from self.update_stats()
+            yield from asyncio.sleep(self.stats_interval, loop=self.root.loop)
+
+    def _get_requirements(self, job):
+        """Return (memory, vcpus) needed for all VMs of job."""
+        memory = vcpus = 0
+        for vm in job.config["vms"]:
+            vm_conf = self.config["vms"][vm["name"]]
+            memory += vm_conf.get("memory", 1024)
+            vcpus += vm_conf.get("vcpu", 1)
+        return memory, vcpus
+
+    def _choose_host(self, memory, vcpus, names=()):
+        """Choose host which fits best using cached stats.
+
+        Hosts with stats older than three polling intervals are skipped.
+        Hosts having ready pooled VMs of given names are preferred, then
+        the host with least free memory left after placement wins.
+        """
+        min_free = self.config.get("freemb", 1024)
+        maxla = self.config.get("maxla", 4)
+        fresh = time.time() - self.stats_interval * 3
+        best = None
+        for host in self.hosts:
+            if not host.ready:
+                continue
+            if host.stats_updated_at < fresh or host.la >= maxla:
+                continue
+            free_memory, free_vcpus = host.get_free_resources()
+            if free_memory < max(memory, min_free):
+                continue
+            if host.nproc and free_vcpus < vcpus:
+                continue
+            key = (not host.has_pooled_vm(names), free_memory)
+            if best is None or key < best[0]:
+                best = (key, host)
+        if best:
+            return best[1]
 
     @asyncio.coroutine
     def start(self):
@@ -361,16 +1308,47 @@ class Provider:
                                listen_port=mds_port,
                                ssh_keys=self.root.config.get_ssh_keys())
         self.mds_future = asyncio.async(self.mds.run(), loop=self.root.loop)
-        command = ("PREROUTING -d 169.254.169.254 -p tcp --dport 80 "
-                   "-j DNAT --to-destination %s:%s")
-        for host in self.hosts:
-            if mds_addr == "0.0.0.0":
-                my_addr = utils.get_local_address(host.ssh.hostname)
-            else:
-                my_addr = mds_addr
-            cmd = command % (my_addr, mds_port)
-            yield from host.ssh.run(("iptables -t nat -C %s ||"
-                                     "iptables -t nat -I %s") % (cmd, cmd))
+        self.stats_future = asyncio.async(self._collect_stats(),
+                                          loop=self.root.loop)
+        self.refresh_future = asyncio.async(self._refresh_images(),
+                                            loop=self.root.loop)
+        self.bootstrap_futures = [
+            asyncio.async(self._bootstrap_host(host, mds_addr, mds_port),
+                          loop=self.root.loop)
+            for host in self.hosts]
+        if self.bootstrap_futures:
+            yield from asyncio.wait(
+                self.bootstrap_futures,
+                timeout=self.config.get("bootstrap-timeout", 60),
+                loop=self.root.loop)
+        stats = self.get_stats()
+        LOG.info("%d of %d hosts ready" % (stats["hosts-ready"],
+                                           stats["hosts"]))
+        yield from self.reap_orphans()
+        self.sweep_future = asyncio.async(self._sweep_orphans(),
+                                          loop=self.root.loop)
+
+    @asyncio.coroutine
+    def _bootstrap_host(self, host, mds_addr, mds_port):
+        """Bootstrap host retrying until it succeeds.
+
+        Unreachable host doesn't block other hosts and is not used for
+        jobs until bootstrapped.
+        """
+        timeout = self.config.get("bootstrap-timeout", 60)
+        interval = self.config.get("bootstrap-retry-interval", 60)
+        while True:
+            try:
+                yield from asyncio.wait_for(host.bootstrap(mds_addr, mds_port),
+                                            timeout, loop=self.root.loop)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOG.warning("Unable to bootstrap %s: %r" % (host, ex))
+            yield from asyncio.sleep(interval, loop=self.root.loop)
+        LOG.info("Host %s is ready" % host)
+        host.start_pools()
 
     @asyncio.coroutine
     def cleanup(self, job):
@@ -380,8 +1358,131 @@ class Provider:
 
     @asyncio.coroutine
     def stop(self):
-        self.mds_future.cancel()
-        yield from self.mds_future
+        for fut in self.bootstrap_futures:
+            fut.cancel()
+        for host in self.hosts:
+            yield from host.stop_pools()
+        # start() may have been interrupted before all futures are created
+        for fut in (self.stats_future, self.refresh_future,
+                    self.sweep_future):
+            if fut is not None:
+                fut.cancel()
+        for host in self.hosts:
+            if host.events_future:
+                host.events_future.cancel()
+        if self.mds_future is not None:
+            self.mds_future.cancel()
+            yield from self.mds_future
+
+    @asyncio.coroutine
+    def _get_latest_image_version(self, host, name):
+        lock = self._image_locks.get(name)
+        if lock is None:
+            lock = self._image_locks[name] = asyncio.Lock(loop=self.root.loop)
+        with (yield from lock):
+            latest = self.image_registry.get(name)
+            if latest is None:
+                for h in self.hosts:
+                    versions = yield from h.get_image_versions(name)
+                    if versions:
+                        latest = max(latest or 0, max(versions))
+            if latest is None:
+                latest = yield from host._build_image(name)
+            self.image_registry[name] = latest
+            return latest
+
+    @asyncio.coroutine
+    def distribute_image(self, host, name):
+        """Make latest version of image available on host.
+
+        Image is built only once on the first host which needs it. Other
+        hosts receive it from a host having the latest version,
+        incrementally if they have an older version. If streaming to host
+        having older version fails (e.g. its versions were built locally
+        and don't match source ones), latest version is built locally.
+
+        :returns: latest version of image
+        """
+        latest = yield from self._get_latest_image_version(host, name)
+        if latest in host.image_versions.get(name, ()):
+            return latest
+        sources = [h for h in self.hosts
+                   if latest in h.image_versions.get(name, ())]
+        if not sources:
+            LOG.warning("No host has image %s@%s" % (name, latest))
+            return (yield from host._build_image(name))
+        with (yield from host.get_image_lock(name)):
+            local = yield from host.get_image_versions(name)
+            if latest in local:
+                return latest
+            source = min(sources, key=lambda h: h.la)
+            common = local & source.image_versions[name]
+            base = max(common) if common else None
+            rebuild = False
+            try:
+                yield from host.receive_image(source, name, latest, base)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if not local:
+                    raise
+                rebuild = True
+                LOG.warning("Unable to stream image %s@%s to %s: %r" % (
+                    name, latest, host, ex))
+                try:
+                    # remove partially received version if any
+                    yield from host.storage.destroy_version(name, latest)
+                except Exception:
+                    pass
+        if rebuild:
+            yield from host.refresh_image(name, latest)
+        yield from host.gc_image(name)
+        return latest
+
+    @asyncio.coroutine
+    def refresh_images(self):
+        """Refresh images which are older than their ttl."""
+        stream = self.config.get("image-distribution") == "stream"
+        for name, conf in self.config.get("images", {}).items():
+            if not conf.get("ttl"):
+                continue
+            hosts = [h for h in self.hosts if h.image_versions.get(name)]
+            if stream:
+                latest = self.image_registry.get(name)
+                hosts = [h for h in hosts if latest in h.image_versions[name]]
+                hosts = hosts[:1]
+            for host in hosts:
+                if not host.image_expired(name):
+                    continue
+                try:
+                    version = yield from host.refresh_image(name)
+                except Exception:
+                    LOG.exception("Error refreshing image %s on %s" % (
+                        name, host))
+                    continue
+                if stream:
+                    self.image_registry[name] = version
+                    for other in self.hosts:
+                        if other is host or not other.image_versions.get(
+                                name):
+                            continue
+                        try:
+                            yield from self.distribute_image(other, name)
+                        except Exception:
+                            LOG.exception("Error distributing image %s to %s"
+                                          % (name, other))
+                yield from host.gc_image(name)
+
+    @asyncio.coroutine
+    def _refresh_images(self):
+        while True:
+            yield from asyncio.sleep(self.config.get("image-refresh-interval",
+                                                     600),
+                                     loop=self.root.loop)
+            try:
+                yield from self.refresh_images()
+            except Exception:
+                LOG.exception("Error refreshing images")
 
     @asyncio.coroutine
     def get_vm(self, name, job):
@@ -395,33 +1496,78 @@ class Provider:
 
     @asyncio.coroutine
     def _get_host_for_job(self, job):
-        host = self._job_host_map.get(job)
-        if not host:
-            with (yield from self._get_host_lock):
-                host = yield from self._get_host()
-            self._job_host_map[job] = host
+        with (yield from self._get_host_lock):
+            host = self._job_host_map.get(job)
+            if not host:
+                memory, vcpus = self._get_requirements(job)
+                names = [vm["name"] for vm in job.config["vms"]]
+                host = yield from self._get_host(memory, vcpus, names)
+                host.reserve(job, memory, vcpus)
+                self._job_host_map[job] = host
         return host
 
     @asyncio.coroutine
-    def _get_host(self):
-        memory_required = self.config.get("freemb", 1024)
-        best = None
-
-        sleep = self.last + 15 - time.time()
-        if sleep > 1:
-            yield from asyncio.sleep(sleep)
-        while best is None:
-            random.shuffle(self.hosts)
-            LOG.debug("Chosing from %s" % self.hosts)
-            for host in self.hosts:
-                yield from host.update_stats()
-                maxla = self.config.get("maxla", 4)
-                if host.free >= memory_required and host.la < maxla:
-                    LOG.debug("Chosen host: %s" % host)
-                    self.last = time.time()
-                    return host
-            LOG.info("All servers are overloaded. Waiting 30 seconds.")
-            yield from asyncio.sleep(30)
+    def _get_host(self, memory, vcpus, names):
+        while True:
+            host = self._choose_host(memory, vcpus, names)
+            if host:
+                LOG.debug("Chosen host: %s" % host)
+                return host
+            LOG.info("All servers are overloaded. Waiting for release.")
+            yield from self.root.scheduler.wait_release(self.stats_interval)
+
+
+NAME_MARKER = "rci-name"
+DEVICES_MARKER = "rci-devices"
+DISK_XML = ('<disk device="disk" type="file">'
+            '<driver cache="unsafe" name="qemu" type="qcow2" />'
+            '<source file={path} /><target bus="virtio" dev={dev} /></disk>')
+BLOCK_DISK_XML = ('<disk device="disk" type="block">'
+                  '<driver cache="none" name="qemu" type="raw" />'
+                  '<source dev={path} /><target bus="virtio" dev={dev} />'
+                  '</disk>')
+NET_XML = ('<interface type="bridge"><source bridge={bridge} />'
+           '<model type="virtio" /><mac address={mac} /></interface>')
+_templates = {}
+
+
+def get_domain_template(memory, vcpu):
+    """Return domain xml of VMs of given size split into parts.
+
+    Template is built once per size. VM name goes between first and
+    second part, disks and interfaces between second and third.
+
+    :returns: tuple of three strings
+    """
+    template = _templates.get((memory, vcpu))
+    if template:
+        return template
+    x = XMLElement(None, "domain", type="kvm")
+    x.se("name").x.text = NAME_MARKER
+    for mem in ("memory", "currentMemory"):
+        x.se(mem, unit="MiB").x.text = str(memory)
+    x.se("vcpu", placement="static").x.text = str(vcpu)
+    cpu = x.se("cpu", mode="host-model")
+    cpu.se("model", fallback="forbid")
+    os = x.se("os")
+    os.se("type", arch="x86_64", machine="pc-1.0").x.text = "hvm"
+    features = x.se("features")
+    features.se("acpi")
+    features.se("apic")
+    features.se("pae")
+    devices = x.se("devices")
+    devices.se("emulator").x.text = "/usr/bin/kvm"
+    devices.se("controller", type="pci", index="0", model="pci-root")
+    devices.se("graphics", type="spice", autoport="yes")
+    mb = devices.se("memballoon", model="virtio")
+    mb.se("address", type="pci", domain="0x0000", bus="0x00",
+          slot="0x09", function="0x0")
+    devices.se(DEVICES_MARKER)
+    xml = x.tostring().decode("utf-8")
+    head, tail = xml.split("<%s />" % DEVICES_MARKER)
+    template = tuple(head.split(NAME_MARKER)) + (tail, )
+    _templates[(memory, vcpu)] = template
+    return template
 
 
 class VM:
@@ -439,28 +1585,11 @@ class VM:
         self._ssh_cache = {}
         self.macs = []
         self.disks = []
+        self.image = None
         self.name = utils.get_rnd_name("rci_" + name)
-        x = XMLElement(None, "domain", type="kvm")
-        self.x = x
-        x.se("name").x.text = self.name
-        for mem in ("memory", "currentMemory"):
-            x.se(mem, unit="MiB").x.text = str(self.cfg.get("memory", 1024))
-        x.se("vcpu", placement="static").x.text = str(self.cfg.get("vcpu", 1))
-        cpu = x.se("cpu", mode="host-model")
-        cpu.se("model", fallback="forbid")
-        os = x.se("os")
-        os.se("type", arch="x86_64", machine="pc-1.0").x.text = "hvm"
-        features = x.se("features")
-        features.se("acpi")
-        features.se("apic")
-        features.se("pae")
-        self.devices = x.se("devices")
-        self.devices.se("emulator").x.text = "/usr/bin/kvm"
-        self.devices.se("controller", type="pci", index="0", model="pci-root")
-        self.devices.se("graphics", type="spice", autoport="yes")
-        mb = self.devices.se("memballoon", model="virtio")
-        mb.se("address", type="pci", domain="0x0000", bus="0x00",
-              slot="0x09", function="0x0")
+        host._owned.add(self.name)
+        self._devices = []
+        self._block_disks = 0
 
     def __repr__(self):
         return "<VM %s>" % (self.name)
@@ -471,6 +1600,21 @@ class VM:
             yield from self.destroy(storage=storage)
             return
         ssh = yield from self.get_ssh()
+        if self.host.events_running:
+            stopped = self.host.domain_stopped(self.name)
+            yield from ssh.run("shutdown -h now")
+            try:
+                yield from asyncio.wait_for(stopped, timeout,
+                                            loop=self.host.root.loop)
+            except asyncio.TimeoutError:
+                yield from self.destroy(storage=storage)
+            finally:
+                waiters = self.host._stop_waiters.get(self.name, [])
+                if stopped in waiters:
+                    waiters.remove(stopped)
+                if not waiters:
+                    self.host._stop_waiters.pop(self.name, None)
+            return
         yield from ssh.run("shutdown -h now")
         deadline = time.time() + timeout
         cmd = "virsh list | grep -q {}".format(self.name)
@@ -487,11 +1631,16 @@ class VM:
     def destroy(self, storage=True):
         cmd = ["virsh", "destroy", self.name]
         yield from self._ssh.run(cmd, check=False)
+        self.host._owned.discard(self.name)
         if storage:
             for disk in self.disks:
                 yield from self.host.storage.destroy(disk)
+                self.host._owned.discard(disk)
+            if self.image:
+                yield from self.host.release_image(*self.image)
+                self.image = None
         for ssh in self._ssh_cache.values():
-            ssh.close()
+            self.host.root.ssh_pool.put(ssh, close=True)
         self._ssh_cache = {}
 
     @asyncio.coroutine
@@ -500,9 +1649,14 @@ class VM:
         ssh = self._ssh_cache.get(user)
         if ssh:
             return ssh
-        ssh = SSH(self.host.root.loop, self.ip, username=user,
-                  keys=self.host.root.config.get_ssh_keys("private"))
-        yield from ssh.wait()
+        ssh = self.host.root.ssh_pool.get(
+            self.ip, username=user,
+            keys=self.host.root.config.get_ssh_keys("private"))
+        try:
+            yield from ssh.wait()
+        except BaseException:
+            self.host.root.ssh_pool.put(ssh, close=True)
+            raise
         self._ssh_cache[user] = ssh
         return ssh
 
@@ -511,54 +1665,42 @@ class VM:
         if hasattr(self, "ip"):
             yield from asyncio.sleep(0)
             return self.ip
-        deadline = time.time() + timeout
-        cmd = ["egrep", "-i", "|".join(self.macs), "/proc/net/arp"]
-        while True:
-            if time.time() > deadline:
-                raise Exception("Unable to find ip of VM %s" % self.cfg)
-            yield from asyncio.sleep(4)
-            LOG.debug("Checking for ip for vm %s (%s)" % (self.name,
-                                                          repr(self.macs)))
-            err, data, err = yield from self._ssh.out(cmd, check=False)
-            for line in data.splitlines():
-                m = IP_RE.match(line)
-                if m:
-                    self.ip = m.group(1)
-                    return
+        LOG.debug("Waiting for ip of vm %s (%s)" % (self.name,
+                                                    repr(self.macs)))
+        macs = [mac.lower() for mac in self.macs]
+        try:
+            self.ip = yield from self.host.ip_watcher.wait(macs, timeout)
+        except asyncio.TimeoutError:
+            raise Exception("Unable to find ip of VM %s" % self.cfg)
 
     @asyncio.coroutine
     def boot(self):
-        conf = "/tmp/.rci-%s.xml" % id(self)
-        with self.fd() as fd:
-            yield from self._ssh.run("cat > '%s'" % conf, stdin=fd)
-        yield from self._ssh.run(["virsh", "create", conf], stderr=print)
-
-    @contextlib.contextmanager
-    def fd(self):
-        xmlfile = tempfile.NamedTemporaryFile()
-        try:
-            fd = open(xmlfile.name, "w+b")
-            et.ElementTree(self.x.x).write(fd)
-            fd.seek(0)
-            yield fd
-        finally:
-            fd.close()
+        yield from self._ssh.run(["virsh", "create", "/dev/stdin"],
+                                 stdin=self.to_xml(), stderr=print)
+
+    def to_xml(self):
+        head, middle, tail = get_domain_template(self.cfg.get("memory", 1024),
+                                                 self.cfg.get("vcpu", 1))
+        return "".join([head, saxutils.escape(self.name), middle] +
+                       self._devices + [tail])
 
     def add_disk(self, path):
-        dev = os.path.split(path)[1].split(".")[0]
+        if path.startswith("/dev/"):
+            dev = "vd" + chr(ord("a") + self._block_disks)
+            self._block_disks += 1
+            template = BLOCK_DISK_XML
+        else:
+            dev = os.path.split(path)[1].split(".")[0]
+            template = DISK_XML
         LOG.debug("Adding disk %s with path %s" % (dev, path))
-        disk = self.devices.se("disk", device="disk", type="file")
-        disk.se("driver", name="qemu", type="qcow2", cache="unsafe")
-        disk.se("source", file=path)
-        disk.se("target", dev=dev, bus="virtio")
+        self._devices.append(template.format(path=saxutils.quoteattr(path),
+                                             dev=saxutils.quoteattr(dev)))
 
     def add_net(self, bridge, mac=None):
         if not mac:
             mac = utils.get_rnd_mac()
-        net = self.devices.se("interface", type="bridge")
-        net.se("source", bridge=bridge)
-        net.se("model", type="virtio")
-        net.se("mac", address=mac)
+        self._devices.append(NET_XML.format(bridge=saxutils.quoteattr(bridge),
+                                            mac=saxutils.quoteattr(mac)))
         self.macs.append(mac)
 
 
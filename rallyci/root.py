@@ -13,12 +13,17 @@
 #    limitations under the License.
 
 import asyncio
+import collections
 from concurrent import futures
 import logging
+import os
 import signal
 import resource
 
+from rallyci.common.ssh import SSHPool
 from rallyci.config import Config
+from rallyci.journal import Journal
+from rallyci.scheduler import Scheduler
 
 
 class Root:
@@ -34,6 +39,11 @@ class Root:
         self.task_set = set()
         self.loop = loop
         self.providers = {}
+        self.services = {}
+        self.journal = None
+        self.scheduler = Scheduler(self)
+        self.stats = collections.Counter()
+        self.ssh_pool = SSHPool(loop)
         self.task_start_handlers = []
         self.task_end_handlers = []
         self.job_end_handlers = []
@@ -71,11 +81,34 @@ class Root:
         """
         if task.event.key in self.task_set:
             self.log.warning("Task '%s' is already running" % task.event.key)
-            return
+            return False
         self.task_set.add(task.event.key)
+        self.stats["tasks-started"] += 1
+        if self.journal:
+            self.journal.record({"type": "task-started", "task": task.id,
+                                 "service": getattr(task.event, "service",
+                                                    None),
+                                 "raw_event": task.event.raw_event})
+            # results of jobs restored from journal belong to new task now
+            for name, result in task.results.items():
+                self.journal.record({"type": "job-status", "task": task.id,
+                                     "job": name, "status": result["status"],
+                                     "result": result})
         fut = self.start_obj(task)
         self.tasks[fut] = task
         fut.add_done_callback(self.task_done_cb)
+        return True
+
+    def cancel_task(self, task):
+        """Cancel running task.
+
+        :param Task task:
+        """
+        for fut, running_task in self.tasks.items():
+            if running_task is task:
+                self.log.info("Cancelling task %s" % task)
+                fut.cancel()
+                return
 
     def task_done_cb(self, fut):
         try:
@@ -88,6 +121,10 @@ class Root:
                 except Exception:
                     self.log.exception(("Exception in task end "
                                         "handler %s %s") % (task, handler))
+            if self.journal:
+                self.journal.record({"type": "task-finished",
+                                     "task": task.id,
+                                     "summary": task.to_dict()})
         except Exception:
             self.log.exception("Error in task_done_cb")
 
@@ -120,13 +157,43 @@ class Root:
         fut.add_done_callback(self._running_cleanups.remove)
 
     def start_services(self):
-        for service in self.config.iter_instances("service", "Service"):
+        for name, service in self.config.iter_named_instances("service",
+                                                              "Service"):
+            self.services[name] = service
             self.start_obj(service)
 
+    def _open_journal(self):
+        pub_dir = self.config.get_value("pub-dir", "/tmp/rally-pub")
+        filename = self.config.get_value("journal-file",
+                                         os.path.join(pub_dir, "journal.log"))
+        self.journal = Journal(self.loop, filename)
+        self.journal.load()
+
+    def resume_tasks(self):
+        """Resubmit tasks which were not finished before restart.
+
+        Jobs which were finished are not run again, their results are
+        taken from journal.
+        """
+        for task_id, task in list(self.journal.tasks.items()):
+            service = self.services.get(task["service"])
+            if hasattr(service, "resume_task"):
+                self.log.info("Resuming task %s (%d jobs finished)" % (
+                    task_id, len(task["jobs"])))
+                service.resume_task(task["raw_event"], task["jobs"])
+            else:
+                self.log.warning("Unable to resume task %s: no service "
+                                 "%s" % (task_id, task["service"]))
+            self.journal.record({"type": "task-finished", "task": task_id})
+
     def _load_config(self):
         self.config = Config(self, self.filename, self.verbose)
         self.config.configure_logging()
         self.log = logging.getLogger(__name__)
+        self.ssh_pool.idle_timeout = self.config.get_value("ssh-idle-timeout",
+                                                           300)
+        self.ssh_pool.max_sessions = self.config.get_value("ssh-max-sessions",
+                                                           10)
 
     @asyncio.coroutine
     def wait_fs(self, fs):
@@ -165,16 +232,37 @@ class Root:
             except Exception:
                 self.log.exception("Error loading new config")
 
+    @asyncio.coroutine
+    def start_providers(self):
+        """Start all providers concurrently.
+
+        Failure of one provider is logged and doesn't prevent others
+        from starting.
+        """
+        providers = list(self.providers.values())
+        results = yield from asyncio.gather(
+            *[provider.start() for provider in providers],
+            return_exceptions=True, loop=self.loop)
+        for provider, result in zip(providers, results):
+            if isinstance(result, Exception):
+                self.log.error("Error starting provider %s: %r" % (
+                    provider.name, result))
+            else:
+                self.log.info("Provider %s started" % provider.name)
+
     @asyncio.coroutine
     def run(self):
         self._load_config()
+        self._open_journal()
         self.start_services()
         for prov in self.config.iter_providers():
             self.providers[prov.name] = prov
-            yield from prov.start()
+        yield from self.start_providers()
+        self.resume_tasks()
         reload_fut = asyncio.async(self.reload(), loop=self.loop)
         yield from self.stop_event.wait()
         self.log.info("Interrupted.")
+        yield from self.journal.close()
         reload_fut.cancel()
         yield from reload_fut
         for obj in self._running_objects:
@@ -184,15 +272,29 @@ class Root:
         if self._running_cleanups:
             yield from asyncio.wait(self._running_cleanups,
                                     return_when=futures.ALL_COMPLETED)
-        for provider in self.providers.values():
-            yield from prov.stop()
+        yield from asyncio.gather(*[provider.stop() for provider in
+                                    self.providers.values()],
+                                  return_exceptions=True, loop=self.loop)
+        self.ssh_pool.close()
         self.log.info("Exit.")
 
     def job_updated(self, job):
+        if self.journal:
+            record = {"type": "job-status", "task": job.task_id,
+                      "job": job.config["name"], "status": job.status}
+            if job.finished_at:
+                record["result"] = job.get_result()
+            self.journal.record(record)
         for cb in self.job_update_handlers:
             cb(job)
 
     def get_daemon_statistics(self):
         usage = resource.getrusage(resource.RUSAGE_SELF)
         return {"type": "daemon-statistics",
-                "memory-used": getattr(usage, "ru_maxrss")}
+                "memory-used": getattr(usage, "ru_maxrss"),
+                "scheduler": self.scheduler.get_stats(),
+                "counters": dict(self.stats),
+                "providers": {name: provider.get_stats()
+                              for name, provider in self.providers.items()
+                              if hasattr(provider, "get_stats")},
+                "ssh-pool": self.ssh_pool.get_stats()}
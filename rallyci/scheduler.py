@@ -0,0 +1,131 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+
+LOG = logging.getLogger(__name__)
+
+PRIORITY_VOTING = 0
+PRIORITY_NON_VOTING = 1
+PRIORITY_MERGED = 2
+
+
+def get_priority(job):
+    """Return priority of job. Lower value means higher priority.
+
+    :param Job job:
+    """
+    if job.event_type == "change-merged":
+        return PRIORITY_MERGED
+    return PRIORITY_VOTING if job.voting else PRIORITY_NON_VOTING
+
+
+class Scheduler:
+    """Admit jobs to providers according to priority and capacity.
+
+    Every provider has a number of slots (``max-jobs`` key of provider
+    config, unlimited if not set). Jobs waiting for a free slot are kept
+    in a priority queue and the next one is started as soon as a slot
+    is released.
+    """
+
+    def __init__(self, root):
+        """
+        :param Root root:
+        """
+        self.root = root
+        self.loop = root.loop
+
+        self._counter = itertools.count()
+        self._queues = collections.defaultdict(list)
+        self._running = collections.defaultdict(set)
+        self._release_waiters = []
+
+    def _get_capacity(self, provider):
+        return self.root.config.data["provider"][provider].get("max-jobs")
+
+    def _has_capacity(self, provider):
+        capacity = self._get_capacity(provider)
+        return capacity is None or len(self._running[provider]) < capacity
+
+    def _dispatch(self, provider):
+        queue = self._queues[provider]
+        while queue and self._has_capacity(provider):
+            priority, seq, job, fut = heapq.heappop(queue)
+            if fut.done():
+                continue
+            self._running[provider].add(job)
+            fut.set_result(None)
+
+    @asyncio.coroutine
+    def acquire(self, job):
+        """Wait until provider of job has a free slot.
+
+        :param Job job:
+        """
+        provider = job.config["provider"]
+        self._dispatch(provider)
+        if self._has_capacity(provider):
+            self._running[provider].add(job)
+            return
+        fut = asyncio.Future(loop=self.loop)
+        entry = (get_priority(job), next(self._counter), job, fut)
+        heapq.heappush(self._queues[provider], entry)
+        LOG.debug("Job %s is waiting for %s" % (job, provider))
+        yield from fut
+
+    def release(self, job):
+        """Free slot occupied by job and start next waiting job.
+
+        Does nothing if job is not running (e.g. cancelled while queued).
+
+        :param Job job:
+        """
+        provider = job.config["provider"]
+        running = self._running[provider]
+        if job not in running:
+            return
+        running.remove(job)
+        self._dispatch(provider)
+        waiters = self._release_waiters
+        self._release_waiters = []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    @asyncio.coroutine
+    def wait_release(self, timeout=None):
+        """Wait until any job releases its slot or timeout expires.
+
+        Providers use this instead of plain sleep while all hosts are busy.
+        """
+        fut = asyncio.Future(loop=self.loop)
+        self._release_waiters.append(fut)
+        try:
+            yield from asyncio.wait([fut], timeout=timeout, loop=self.loop)
+        finally:
+            if fut in self._release_waiters:
+                self._release_waiters.remove(fut)
+
+    def get_stats(self):
+        stats = {}
+        for provider in set(self._queues) | set(self._running):
+            queued = [e for e in self._queues[provider] if not e[3].done()]
+            stats[provider] = {"queued": len(queued),
+                               "running": len(self._running[provider])}
+        return stats
@@ -13,15 +13,18 @@
 #    limitations under the License.
 
 import asyncio
-import re
+import collections
 import json
+import re
+import time
 
-from rallyci.common.ssh import SSH
 from rallyci import base
 from rallyci import utils
 from rallyci import task
 
 
+RE_PROJECT = re.compile(rb'"project"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
 EVENT_TYPES = {
     "patchset-created": "patchset-created",
     "ref-updated": "change-merged",
@@ -35,6 +38,7 @@ class Event(base.BaseEvent):
         :param cfg: service config section
         """
         self.raw_event = raw_event
+        self.service = cfg.get("name")
         self.env = _get_env(raw_event, cfg.get("env", {}))
         self.project = _get_project_name(raw_event)
         self.event_type = EVENT_TYPES.get(raw_event["type"], "unknown")
@@ -54,27 +58,103 @@ class Event(base.BaseEvent):
 
 
 class Service:
-    data = ""
-    tasks = {}
 
     def __init__(self, root, **kwargs):
         self.root = root
         self.log = root.log
         self.loop = root.loop
         self.cfg = kwargs
+        self.framer = utils.LineFramer(self.cfg.get("max-event-size",
+                                                    8 * 1024 * 1024))
+        self.changes = {}
+        self.last_event_at = None
+        self._pending_merges = {}
+        self._ref_updated_at = {}
+        self._seen_keys = collections.OrderedDict()
         self.handler_map = {
             "comment-added": self._handle_comment_added,
             "patchset-created": self._start_task,
-            "ref-updated": self._start_task,
+            "ref-updated": self._handle_ref_updated,
             "ref-replicated": self._ignore_event,
         }
+        self.root.task_end_handlers.append(self._forget_task)
 
     def _ignore_event(self, raw_event):
         pass
 
-    def _start_task(self, raw_event):
+    def _start_task(self, raw_event, results=None):
         event = Event(self.cfg, raw_event)
-        self.root.start_task(task.Task(self.root, event))
+        self._remember_key(event.key)
+        change = _get_change_key(raw_event)
+        if change and self.cfg.get("supersede-patchsets", True):
+            if not self._supersede(change, raw_event):
+                self.log.info("Dropping event for outdated patchset of %s" %
+                              (change, ))
+                return
+        new_task = task.Task(self.root, event, results)
+        if self.root.start_task(new_task) and change:
+            self.changes[change] = new_task
+
+    def _supersede(self, change, raw_event):
+        """Cancel task running for older patchset of the same change.
+
+        Return False if task for newer patchset is already running.
+        """
+        old_task = self.changes.get(change)
+        if old_task is None:
+            return True
+        old = _get_patchset_number(old_task.event.raw_event)
+        new = _get_patchset_number(raw_event)
+        if old < new:
+            self.log.info("Patchset %s of %s supersedes %s" % (new, change,
+                                                               old_task))
+            del self.changes[change]
+            old_task.superseded = True
+            self.root.cancel_task(old_task)
+        return old <= new
+
+    def resume_task(self, raw_event, results):
+        """Start task interrupted by restart.
+
+        :param dict results: results of jobs finished before restart
+        """
+        self._start_task(raw_event, results)
+
+    def _remember_key(self, key):
+        self._seen_keys.pop(key, None)
+        self._seen_keys[key] = True
+        if len(self._seen_keys) > self.cfg.get("seen-events-cache", 1024):
+            self._seen_keys.popitem(last=False)
+
+    def _forget_task(self, finished_task):
+        change = _get_change_key(finished_task.event.raw_event)
+        if self.changes.get(change) is finished_task:
+            del self.changes[change]
+
+    def _handle_ref_updated(self, raw_event):
+        """Start task for merged commit.
+
+        If merge-coalesce-window is configured, merges of the same branch
+        arrived within window are collapsed into single task for the
+        newest revision.
+        """
+        window = self.cfg.get("merge-coalesce-window", 0)
+        if not window:
+            return self._start_task(raw_event)
+        ref = raw_event["refUpdate"]
+        key = (ref["project"], _get_ref_name(ref["refName"]))
+        if key in self._pending_merges:
+            self.log.debug("Coalescing merge %s into %s" % (ref["newRev"],
+                                                            key))
+            self.root.stats["gerrit-merged-runs-saved"] += 1
+        else:
+            self.loop.call_later(window, self._flush_merge, key)
+        self._pending_merges[key] = raw_event
+
+    def _flush_merge(self, key):
+        raw_event = self._pending_merges.pop(key, None)
+        if raw_event:
+            self._start_task(raw_event)
 
     def _handle_comment_added(self, raw_event):
         r = self.cfg.get("recheck-regexp", "^rally-ci recheck$")
@@ -84,7 +164,19 @@ class Service:
             self._start_task(raw_event)
 
     def _handle_event(self, event):
-        event = json.loads(event)
+        event = json.loads(event.decode("utf-8"))
+        created_on = event.get("eventCreatedOn",
+                               event.get("patchSet", {}).get("createdOn"))
+        if created_on:
+            self.last_event_at = max(created_on, self.last_event_at or 0)
+        if event["type"] == "ref-updated":
+            ref = event["refUpdate"]
+            key = (ref["project"], _get_ref_name(ref["refName"]))
+            self._ref_updated_at[key] = max(created_on or time.time(),
+                                            self._ref_updated_at.get(key, 0))
+        self._dispatch_event(event)
+
+    def _dispatch_event(self, event):
         project = _get_project_name(event)
         self.log.debug("Event '%s' for project '%s'" % (event["type"],
                                                         project))
@@ -102,43 +194,116 @@ class Service:
     def _handle_stderr(self, data):
         self.log.warning("Error message from gerrit: %s" % data)
 
+    def _is_interesting(self, line):
+        """Check project of raw event without decoding whole event.
+
+        Events with no recognizable project are considered interesting.
+        """
+        projects = RE_PROJECT.findall(line)
+        if not projects or any(b"\\" in p for p in projects):
+            return True
+        is_configured = self.root.config.is_project_configured
+        return any(is_configured(p.decode("utf-8")) for p in projects)
+
     def _handle_stdout(self, data):
-        self.data += data
-        while "\n" in self.data:
-            line, self.data = self.data.split("\n", 1)
+        for line in self.framer.feed(data):
+            self.root.stats["gerrit-events-received"] += 1
+            if not self._is_interesting(line):
+                self.root.stats["gerrit-events-filtered"] += 1
+                continue
             try:
                 self._handle_event(line)
             except:
-                self.log.exception("Error handling data %s" % self.data)
+                self.log.exception("Error handling data %s" % line)
+
+    @asyncio.coroutine
+    def replay(self, filename, rate=0):
+        """Feed recorded stream to event handlers.
+
+        :param str filename: file with one json encoded event per line
+        :param float rate: events per second (0 means as fast as possible)
+        """
+        delay = 1.0 / rate if rate else 0
+        with open(filename, "rb") as fs:
+            for line in fs:
+                self._handle_stdout(line)
+                yield from asyncio.sleep(delay, loop=self.loop)
+
+    @asyncio.coroutine
+    def _catch_up(self, since):
+        """Start tasks for events missed while stream was disconnected.
+
+        Changes updated since given time are fetched by "gerrit query"
+        and converted to patchset-created and ref-updated events.
+
+        :param int since: unix timestamp of last received event
+        """
+        projects = self.root.config.get_configured_projects()
+        if not projects:
+            return
+        age = int(time.time() - since) + self.cfg.get("catch-up-margin", 60)
+        query = "-age:%ds (%s)" % (age, " OR ".join("project:" + p
+                                                    for p in projects))
+        self.log.info("Catching up events since %s" % since)
+        cmd = ["gerrit", "query", "--format=JSON", "--current-patch-set",
+               query]
+        status, out, err = yield from self.ssh.out(cmd)
+        for line in out.splitlines():
+            change = json.loads(line)
+            raw_event = _get_missed_event(change, since)
+            if raw_event is None:
+                continue
+            if Event(self.cfg, raw_event).key in self._seen_keys:
+                continue
+            if raw_event["type"] == "ref-updated":
+                # merged commit is not known from query, so merge is
+                # skipped if branch was updated by live event since then
+                ref = raw_event["refUpdate"]
+                key = (ref["project"], ref["refName"])
+                if self._ref_updated_at.get(key, 0) >= change["lastUpdated"]:
+                    continue
+            self.log.info("Replaying missed %s for %s" % (
+                raw_event["type"], change["url"]))
+            self.root.stats["gerrit-events-replayed"] += 1
+            self._dispatch_event(raw_event)
 
     @asyncio.coroutine
     def run(self):
         fake_stream = self.cfg.get("fake-stream")
         if fake_stream:
+            rate = self.cfg.get("fake-stream-rate", 1.0 / 3)
             while True:
-                with open(fake_stream) as fs:
-                    for line in fs:
-                        self._handle_stdout(line)
-                        yield from asyncio.sleep(3)
+                yield from self.replay(fake_stream, rate)
+                if not self.cfg.get("fake-stream-loop", True):
+                    return
                 self.log.info("Stream ended. Starting from beginning.")
-            return
         if "port" not in self.cfg["ssh"]:
             self.cfg["ssh"]["port"] = 29418
 
         self.cfg["ssh"]["keys"] = self.root.config.get_ssh_keys(
                 keytype="private")
-        self.ssh = SSH(self.loop, **self.cfg["ssh"])
+        self.ssh = self.root.ssh_pool.get(**self.cfg["ssh"])
+        self.publish_queue = asyncio.Queue(loop=self.loop)
+        self._load_unpublished()
+        publishers = [self.root.start_coro(self._publisher()) for i in
+                      range(self.cfg.get("publish-concurrency", 4))]
         self.root.task_end_handlers.append(self._handle_task_end)
         reconnect_delay = self.cfg.get("reconnect_delay", 5)
         while True:
+            if self.last_event_at and self.cfg.get("catch-up", True):
+                self.root.start_coro(self._catch_up(self.last_event_at))
             try:
                 status = yield from self.ssh.run("gerrit stream-events",
                                                  stdout=self._handle_stdout,
-                                                 stderr=self._handle_stderr)
+                                                 stderr=self._handle_stderr,
+                                                 decode=False)
                 self.log.info("Gerrit stream exited with status %s" % status)
             except asyncio.CancelledError:
                 self.log.info("Stopping gerrit")
-                del self.ssh
+                self.root.task_end_handlers.remove(self._handle_task_end)
+                for fut in publishers:
+                    fut.cancel()
+                self.root.ssh_pool.put(self.ssh)
                 return
             except:
                 self.log.exception("Error listening gerrit events")
@@ -146,16 +311,26 @@ class Service:
             yield from asyncio.sleep(reconnect_delay)
 
     def _handle_task_end(self, task):
-        self.root.start_coro(self.publish_results(task))
+        if task.superseded or task.cancelled:
+            self.log.info("Not publishing results of cancelled %s" % task)
+            return
+        cmd = self._get_review_cmd(task)
+        if cmd:
+            self.root.journal.record({"type": "review", "id": task.id,
+                                      "service": self.cfg["name"],
+                                      "cmd": cmd})
+            self.publish_queue.put_nowait((task.id, cmd))
 
-    @asyncio.coroutine
-    def publish_results(self, task):
+    def _get_review_cmd(self, task):
+        """Return "gerrit review" command for finished task.
+
+        Return None if there is nothing to publish.
+        """
         if self.cfg.get("silent"):
-            return (yield from asyncio.sleep(0))
+            return
         revision = task.event.raw_event.get("patchSet", {}).get("revision")
         if not revision:
-            return (yield from asyncio.sleep(0))
-        self.log.debug("Publishing results for task %s" % self)
+            return
         comment_header = self.cfg.get("comment-header")
         if not comment_header:
             self.log.warning("No comment-header configured. Can't publish.")
@@ -169,15 +344,59 @@ class Service:
         tpl = self.cfg["comment-job-template"]
         for job in task.jobs:
             success = job.status + ("" if job.voting else " (non-voting)")
-            time = utils.human_time(job.finished_at - job.started_at)
+            started_at = getattr(job, "started_at", job.finished_at)
+            duration = utils.human_time(job.finished_at - started_at)
             summary += tpl.format(success=success,
                                   name=job.config["name"],
-                                  time=time,
+                                  time=duration,
                                   log_path=job.log_path)
             summary += "\n"
         summary += task.summary
         cmd += ["-m", summary, revision]
-        yield from self.ssh.run(cmd)
+        return cmd
+
+    def _load_unpublished(self):
+        unpublished = [(review_id, review["cmd"]) for review_id, review
+                       in self.root.journal.reviews.items()
+                       if review["service"] == self.cfg["name"]]
+        for item in unpublished:
+            self.publish_queue.put_nowait(item)
+        if unpublished:
+            self.log.info("Loaded %d unpublished results" % len(unpublished))
+
+    @asyncio.coroutine
+    def _publisher(self):
+        while True:
+            review_id, cmd = yield from self.publish_queue.get()
+            yield from self.publish(cmd, review_id)
+
+    @asyncio.coroutine
+    def publish(self, cmd, review_id=None):
+        """Run "gerrit review" command, retrying with backoff on errors.
+
+        :param list cmd: command returned by _get_review_cmd
+        :param str review_id: id of review record in journal
+        """
+        retries = self.cfg.get("publish-retries", 5)
+        delay = self.cfg.get("publish-retry-delay", 10)
+        for attempt in range(retries + 1):
+            try:
+                yield from self.ssh.run(cmd)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception("Error publishing %s (attempt %d)" % (
+                    cmd[-1], attempt + 1))
+                if attempt < retries:
+                    yield from asyncio.sleep(delay * 2 ** attempt,
+                                             loop=self.loop)
+        else:
+            # review stays in journal and is published after restart
+            self.log.error("Giving up publishing results for %s" % cmd[-1])
+            return
+        if review_id:
+            self.root.journal.record({"type": "published", "id": review_id})
 
 
 def _get_project_name(e):
@@ -185,6 +404,46 @@ def _get_project_name(e):
                                    e.get("refUpdate", {}).get("project"))
 
 
+def _get_missed_event(change, since):
+    """Convert result of gerrit query to stream event.
+
+    Return None if change was not updated since given time.
+
+    :param dict change: change as returned by gerrit query
+    :param int since: unix timestamp
+    """
+    patchset = change.get("currentPatchSet")
+    if patchset is None:
+        return None
+    if change["status"] == "NEW" and patchset["createdOn"] >= since:
+        event = {"type": "patchset-created", "patchSet": patchset}
+        event["change"] = {k: v for k, v in change.items()
+                           if k not in ("currentPatchSet", "patchSets")}
+        return event
+    if change["status"] == "MERGED" and change["lastUpdated"] >= since:
+        return {"type": "ref-updated",
+                "refUpdate": {"project": change["project"],
+                              "refName": _get_ref_name(change["branch"]),
+                              "newRev": patchset["revision"]}}
+
+
+def _get_ref_name(name):
+    """Return full ref name for branch name as it is in stream events."""
+    if name.startswith("refs/"):
+        return name
+    return "refs/heads/" + name
+
+
+def _get_change_key(e):
+    change = e.get("change")
+    if change and "patchSet" in e:
+        return (change["project"], change.get("branch"), change["id"])
+
+
+def _get_patchset_number(e):
+    return int(e["patchSet"]["number"])
+
+
 def _get_env(event, cfg):
     """Get event environment.
 
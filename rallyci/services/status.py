@@ -141,6 +141,8 @@ class Service:
 
     @asyncio.coroutine
     def run(self):
+        if self.root.journal:
+            self._finished.extend(self.root.journal.finished)
         self.stats_sender = periodictask.PeriodicTask(
             self.config.get("stats-interval", 60),
             self._send_daemon_statistic,
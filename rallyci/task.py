@@ -25,14 +25,19 @@ from rallyci import utils
 
 class Task:
     summary = ""
+    cancelled = False
+    superseded = False
 
-    def __init__(self, root, event):
+    def __init__(self, root, event, results=None):
         """
         :param Root root:
         :param Event event:
+        :param dict results: job name -> result of jobs finished before
+            restart, these jobs are not run again
         """
         self.root = root
         self.event = event
+        self.results = results or {}
 
         self.local_config = None
         self.jobs = []
@@ -72,6 +77,10 @@ class Task:
     def _start_job(self, config, voting=False):
         job = Job(self, config, voting)
         self.jobs.append(job)
+        result = self.results.get(config["name"])
+        if result:
+            job.restore(result)
+            return
         fut = self.root.start_obj(job)
         self._job_futures[fut] = job
         fut.add_done_callback(self._job_done_cb)
@@ -103,14 +112,23 @@ class Task:
             return
         for cb in self.root.task_start_handlers:
             cb(self)
+        if not self._job_futures:
+            # all jobs are restored from journal
+            self.finished_at = time.time()
+            self._finished.set()
         while not self._finished.is_set():
             try:
                 yield from self._finished.wait()
                 self.finished_at = time.time()
             except asyncio.CancelledError:
                 self.root.log.info("Cancelled %s" % self)
-                for fut in self._job_futures:
+                self.cancelled = True
+                futures = list(self._job_futures)
+                for fut in futures:
                     fut.cancel()
+                if futures:
+                    yield from asyncio.wait(futures, loop=self.root.loop)
+                self.finished_at = time.time()
                 return
 
     @asyncio.coroutine
@@ -126,6 +126,51 @@ def retry(fun, *args, **kwargs):
     raise e
 
 
+class LineFramer:
+    """Split stream of bytes into lines.
+
+    Data is accumulated in single buffer which is scanned only once, so
+    handling of big chunks is linear in their size. Lines longer than
+    max_line are dropped.
+    """
+
+    def __init__(self, max_line=None):
+        self.max_line = max_line
+        self._buf = bytearray()
+        self._scanned = 0
+        self._skip = False
+
+    def feed(self, data):
+        """Add data to buffer.
+
+        :param data: bytes or str
+        :returns: list of complete lines (bytes, without newline)
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        buf = self._buf
+        buf += data
+        lines = []
+        start = 0
+        while True:
+            end = buf.find(b"\n", self._scanned)
+            if end == -1:
+                break
+            if self._skip:
+                self._skip = False
+            else:
+                lines.append(bytes(buf[start:end]))
+            start = self._scanned = end + 1
+        del buf[:start]
+        self._scanned = len(buf)
+        if self.max_line and len(buf) > self.max_line:
+            LOG.warning("Dropping line longer than %s bytes" % self.max_line)
+            del buf[:]
+            self._scanned = 0
+            self._skip = True
+        return lines
+
+
 class LogDel:
     def __del__(self):
         print("DELETED %s" % self)
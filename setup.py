@@ -11,5 +11,6 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=["pyyaml", "aiohttp", "asyncssh"],
-    entry_points={"console_scripts": ["rally-ci = rallyci.daemon:run"]}
+    entry_points={"console_scripts": ["rally-ci = rallyci.daemon:run",
+                                      "rally-ci-bench = rallyci.bench:run"]}
 )
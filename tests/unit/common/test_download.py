@@ -0,0 +1,73 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import unittest
+from unittest import mock
+
+from rallyci.common import download
+
+HEADERS = """HTTP/1.1 302 Found
+Location: https://mirror/img
+ETag: "redirect"
+
+HTTP/1.1 200 OK
+Content-Length: 100
+ETag: "abc"
+Last-Modified: Tue, 01 Mar 2016 10:00:00 GMT
+"""
+
+
+class DownloadCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_parse_validators(self):
+        self.assertEqual(('"abc"', "Tue, 01 Mar 2016 10:00:00 GMT"),
+                         download.parse_validators(HEADERS))
+        self.assertEqual(("", ""), download.parse_validators(""))
+
+    def test_get_key(self):
+        key = download.get_key("http://img", '"abc"')
+        self.assertEqual(key, download.get_key("http://img", '"abc"'))
+        self.assertNotEqual(key, download.get_key("http://img", '"abd"'))
+        self.assertNotEqual(key, download.get_key("http://img2", '"abc"'))
+
+    def test_fetch(self):
+        ssh = mock.Mock(loop=self.loop)
+        scripts = []
+
+        @asyncio.coroutine
+        def out(cmd, check=True):
+            return 0, HEADERS, ""
+
+        @asyncio.coroutine
+        def run(cmd, stdin=None, stderr=None):
+            scripts.append(stdin)
+
+        ssh.out = out
+        ssh.run = run
+        cache = download.DownloadCache(ssh, "/var/cache/rci")
+        self.loop.run_until_complete(
+            cache.fetch("http://img", "/ci/u1404/vda.qcow2", sha256="f00"))
+        key = download.get_key("http://img", '"abc"',
+                               "Tue, 01 Mar 2016 10:00:00 GMT")
+        script = scripts[0]
+        self.assertIn("curl -fsSL --retry 3 -C - -o %s.part" % key, script)
+        self.assertIn("echo f00'  '%s.part | sha256sum -c" % key, script)
+        self.assertIn("cp --reflink=auto %s /ci/u1404/vda.qcow2" % key, script)
@@ -0,0 +1,62 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import unittest
+
+from rallyci.common import watcher
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_wait(self):
+        polls = []
+
+        @asyncio.coroutine
+        def poll():
+            polls.append(1)
+            if len(polls) < 2:
+                return {}
+            return {"m1": "10.0.0.1", "m3": "10.0.0.3"}
+
+        w = watcher.Watcher(self.loop, poll, 0)
+
+        @asyncio.coroutine
+        def wait_all():
+            return (yield from asyncio.gather(w.wait(["m1"], 1),
+                                              w.wait(["m2", "m3"], 1),
+                                              loop=self.loop))
+
+        result = self.loop.run_until_complete(wait_all())
+        self.assertEqual(["10.0.0.1", "10.0.0.3"], result)
+        self.assertEqual(2, len(polls))
+        self.assertEqual({}, w._waiters)
+
+    def test_wait_timeout(self):
+
+        @asyncio.coroutine
+        def poll():
+            return {}
+
+        w = watcher.Watcher(self.loop, poll, 0)
+        self.assertRaises(asyncio.TimeoutError, self.loop.run_until_complete,
+                          w.wait(["m1"], 0.01))
+        self.assertEqual({}, w._waiters)
+        self.loop.run_until_complete(w._future)
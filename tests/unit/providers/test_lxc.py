@@ -0,0 +1,82 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+from rallyci.providers import lxc
+
+
+class GetVMTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.host = lxc.Host.__new__(lxc.Host)
+        self.host.provider = Mock()
+        self.host.job_vm = {}
+        self.host._owned = set()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_get_vm_cancelled(self):
+        loop = self.loop
+        host = self.host
+        commands = []
+
+        @asyncio.coroutine
+        def build_image(image, job):
+            pass
+
+        @asyncio.coroutine
+        def get_ip(name):
+            yield from asyncio.sleep(10, loop=loop)
+
+        @asyncio.coroutine
+        def run(cmd, **kwargs):
+            commands.append(cmd[0])
+
+        host._build_image = build_image
+        host._get_ip = get_ip
+        host.ssh = Mock(run=run)
+        fut = asyncio.async(host.get_vm("u1404", "job"), loop=loop)
+        loop.call_later(0.01, fut.cancel)
+        self.assertRaises(asyncio.CancelledError, loop.run_until_complete,
+                          fut)
+        self.assertEqual(["lxc-clone", "lxc-start", "lxc-destroy"], commands)
+        self.assertEqual(set(), host._owned)
+        self.assertEqual({}, host.job_vm)
+
+
+class VMTestCase(unittest.TestCase):
+
+    def test_get_ssh_error(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        host = Mock()
+        pool = host.provider.root.ssh_pool
+        ssh = pool.get.return_value
+
+        @asyncio.coroutine
+        def wait():
+            raise ConnectionRefusedError()
+
+        ssh.wait = wait
+        vm = lxc.VM(host, "job", "10.0.0.2", "rci_1")
+        self.assertRaises(ConnectionRefusedError, loop.run_until_complete,
+                          vm.get_ssh())
+        pool.put.assert_called_once_with(ssh, close=True)
+        self.assertEqual({}, vm._ssh_cache)
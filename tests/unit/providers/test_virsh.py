@@ -0,0 +1,570 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+import asyncio
+import collections
+import unittest
+from unittest.mock import Mock
+from xml.etree import ElementTree
+
+from rallyci.providers import virsh
+
+
+def get_fake_ssh(output="", commands=None):
+    """Return fake SSH.
+
+    :param output: stdout of out(), or function returning stdout for cmd
+    :param list commands: commands passed to run() are appended here
+    """
+    ssh = Mock(hostname="h1")
+
+    @asyncio.coroutine
+    def out(cmd, **kwargs):
+        return 0, output(cmd) if callable(output) else output, ""
+
+    @asyncio.coroutine
+    def run(cmd, **kwargs):
+        if commands is not None:
+            commands.append(cmd)
+        return 0
+
+    ssh.out = out
+    ssh.run = run
+    return ssh
+
+
+class HostTestCase(unittest.TestCase):
+
+    @unittest.mock.patch("rallyci.providers.virsh.time")
+    def test__get_pool_size(self, mock_time):
+        mock_time.time.return_value = 1000
+        provider = Mock(config={
+            "storage": {"path": "path", "backend": "btrfs"},
+            "warm-pool": {"vm": {"min": 1, "max": 3, "window": 100}}})
+        h = virsh.Host({}, provider, Mock())
+        self.assertEqual(0, h._get_pool_size("other"))
+        self.assertEqual(1, h._get_pool_size("vm"))
+        h._boot_times["vm"] = 60
+        h._pool_requests["vm"].extend([850] + [950] * 4)
+        self.assertEqual(3, h._get_pool_size("vm"))
+        self.assertEqual(4, len(h._pool_requests["vm"]))
+        h._boot_times["vm"] = 30
+        self.assertEqual(2, h._get_pool_size("vm"))
+
+    def test__pooled_vm_died(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        provider = Mock(config={
+            "storage": {"path": "path", "backend": "btrfs"},
+            "vms": {"vm": {"memory": 512}},
+            "warm-pool": {"vm": {"min": 1, "max": 1}}})
+        root = Mock(loop=loop)
+        h = virsh.Host({}, provider, root)
+        vm = Mock()
+        vm.name = "rci_vm_1"
+
+        @asyncio.coroutine
+        def get_vm(name, conf):
+            return vm
+
+        @asyncio.coroutine
+        def get_ssh():
+            pass
+
+        h._get_vm = get_vm
+        vm.get_ssh = get_ssh
+        loop.run_until_complete(h._fill_pool("vm"))
+        self.assertEqual([vm], h._pools["vm"])
+        self.assertEqual(["rci_vm_1"], list(h._reservations))
+        h._handle_event("event 'lifecycle' for domain rci_vm_1: "
+                        "Crashed Panicked")
+        self.assertEqual([], h._pools["vm"])
+        self.assertEqual({}, h._reservations)
+        vm.destroy.assert_called_once_with()
+        self.assertIsNone(h._get_pooled_vm("vm"))
+
+
+class UtilsTestCase(unittest.TestCase):
+
+    def test_parse_neighbours(self):
+        data = """IP address  HW type  Flags  HW address  Mask  Device
+10.1.1.5         0x1         0x2         52:54:00:AA:BB:01     *        br1
+10.1.1.6         0x1         0x0         00:00:00:00:00:00     *        br1
+1466000000 52:54:00:aa:bb:02 10.1.2.7 rci_vm *
+"""
+        self.assertEqual({"52:54:00:aa:bb:01": "10.1.1.5",
+                          "52:54:00:aa:bb:02": "10.1.2.7"},
+                         virsh.parse_neighbours(data))
+
+
+class ProviderTestCase(unittest.TestCase):
+
+    def test_stream_unsupported(self):
+        config = {"name": "name", "image-distribution": "stream",
+                  "storage": {"backend": "qcow2", "path": "/ci"}}
+        self.assertRaisesRegex(ValueError, "qcow2", virsh.Provider, Mock(),
+                               config)
+        config["storage"] = {"backend": "zfs", "dataset": "tank/ci"}
+        virsh.Provider(Mock(), config)
+
+    @unittest.mock.patch("rallyci.providers.virsh.time")
+    def test__choose_host(self, mock_time):
+        mock_time.time.return_value = 1000
+        p = virsh.Provider(Mock(), {"name": "name", "freemb": 1024,
+                                    "stats-interval": 10})
+
+        def get_host(free, la=0.0, updated_at=990, nproc=4, vcpus=16):
+            host = Mock(la=la, stats_updated_at=updated_at, nproc=nproc)
+            host.has_pooled_vm.return_value = False
+            host.get_free_resources.return_value = (free, vcpus)
+            return host
+
+        stale = get_host(8192, updated_at=900)
+        busy = get_host(8192, la=8.0)
+        no_cpu = get_host(8192, vcpus=0)
+        small = get_host(2048)
+        smallest = get_host(3072)
+        big = get_host(4096)
+        p.hosts = [stale, busy, no_cpu, small]
+        self.assertIsNone(p._choose_host(3000, 2))
+        p.hosts = [stale, busy, no_cpu, small, big, smallest]
+        self.assertEqual(smallest, p._choose_host(3000, 2))
+        big.has_pooled_vm.return_value = True
+        self.assertEqual(big, p._choose_host(3000, 2, ["vm"]))
+
+    def test__bootstrap_host(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        p = virsh.Provider(Mock(loop=loop), {"name": "name",
+                                             "bootstrap-retry-interval": 0})
+        host = Mock(ready=False)
+        attempts = []
+
+        @asyncio.coroutine
+        def bootstrap(addr, port):
+            attempts.append((addr, port))
+            if len(attempts) == 1:
+                raise ConnectionError()
+            host.ready = True
+
+        host.bootstrap = bootstrap
+        p.hosts = [host, Mock(ready=False)]
+        loop.run_until_complete(p._bootstrap_host(host, "1.2.3.4", 8088))
+        self.assertEqual(2, len(attempts))
+        host.start_pools.assert_called_once_with()
+        self.assertEqual({"hosts": 2, "hosts-ready": 1}, p.get_stats())
+
+    def test_stop_not_started(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        p = virsh.Provider(Mock(loop=loop), {"name": "name"})
+        loop.run_until_complete(p.stop())
+        p.stats_future = stats_future = asyncio.Future(loop=loop)
+        loop.run_until_complete(p.stop())
+        self.assertTrue(stats_future.cancelled())
+
+    def test_distribute_image_rebuild(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        p = virsh.Provider(Mock(loop=loop), {"name": "name"})
+        p.image_registry = {"u1404": 2}
+        refreshed = []
+
+        def get_host(hostname, versions):
+            host = virsh.Host.__new__(virsh.Host)
+            host.root = p.root
+            host.ssh = get_fake_ssh()
+            host.ssh.hostname = hostname
+            host.la = host.free = 0
+            host._reservations = {}
+            host.image_locks = {}
+            host.image_versions = {"u1404": versions}
+            host.storage = Mock(destroy_version=noop)
+            host.gc_image = noop
+            return host
+
+        @asyncio.coroutine
+        def noop(*args):
+            pass
+
+        @asyncio.coroutine
+        def receive_image(source, name, version, base):
+            raise ConnectionError()
+
+        @asyncio.coroutine
+        def refresh_image(name, version):
+            refreshed.append((name, version))
+            return version
+
+        src = get_host("h1", {1, 2})
+        dst = get_host("h2", {1})
+        dst.receive_image = receive_image
+        dst.refresh_image = refresh_image
+        p.hosts = [src, dst]
+        self.assertEqual(2, loop.run_until_complete(
+            p.distribute_image(dst, "u1404")))
+        self.assertEqual([("u1404", 2)], refreshed)
+        dst.image_versions["u1404"] = set()
+        self.assertRaises(ConnectionError, loop.run_until_complete,
+                          p.distribute_image(dst, "u1404"))
+
+    def test_refresh_images_distribute_error(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        p = virsh.Provider(Mock(loop=loop), {
+            "name": "name", "image-distribution": "stream",
+            "storage": {"backend": "zfs", "dataset": "tank/ci"},
+            "images": {"u1404": {"ttl": 60}}})
+        p.image_registry = {"u1404": 2}
+        hosts = [Mock(image_versions={"u1404": {2}}) for i in range(3)]
+        hosts[0].image_expired.return_value = True
+        distributed = []
+        collected = []
+
+        @asyncio.coroutine
+        def refresh_image(name):
+            return 3
+
+        @asyncio.coroutine
+        def gc_image(name):
+            collected.append(name)
+
+        @asyncio.coroutine
+        def distribute_image(host, name):
+            distributed.append(host)
+            if host is hosts[1]:
+                raise ConnectionError()
+
+        hosts[0].refresh_image = refresh_image
+        hosts[0].gc_image = gc_image
+        p.hosts = hosts
+        p.distribute_image = distribute_image
+        loop.run_until_complete(p.refresh_images())
+        self.assertEqual(hosts[1:], distributed)
+        self.assertEqual(["u1404"], collected)
+        self.assertEqual(3, p.image_registry["u1404"])
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def test_zfs_send_receive_cmd(self):
+        zfs = virsh.ZFS(None, "/ci", "tank/ci")
+        self.assertEqual(["zfs", "send", "-i", "@1", "tank/ci/u1404@2"],
+                         zfs.get_send_cmd("u1404", 2, 1))
+        self.assertEqual(["zfs", "receive", "-F", "tank/ci/u1404"],
+                         zfs.get_receive_cmd("u1404"))
+
+    def _get_storage(self, backend, output="", **kwargs):
+        self.commands = []
+        return backend(get_fake_ssh(output, self.commands), **kwargs)
+
+    def test_lvm(self):
+        lvm = self._get_storage(virsh.LVM, "  u1404\n  u1404.v1\n  u1404.v2\n"
+                                "  u1404.v2x\n  rci_1\n",
+                                vg="vg", pool="thin")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual({1, 2},
+                         loop.run_until_complete(lvm.get_versions("u1404")))
+        loop.run_until_complete(lvm.clone("u1404", "rci_1", 2))
+        loop.run_until_complete(lvm.destroy_version("u1404", 1))
+        self.assertEqual([["lvcreate", "-s", "-kn", "-n", "rci_1",
+                           "vg/u1404.v2"],
+                          ["lvremove", "-f", "vg/u1404.v1"]], self.commands)
+        self.assertEqual(["/dev/vg/rci_1"],
+                         loop.run_until_complete(lvm.list_files("rci_1")))
+
+    def test_qcow2(self):
+        qcow2 = self._get_storage(virsh.QCOW2, "/ci/u1404@1\n/ci/u1404@3\n",
+                                  path="/ci")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual({1, 3},
+                         loop.run_until_complete(qcow2.get_versions("u1404")))
+        loop.run_until_complete(qcow2.clone("u1404", "rci_1", 3))
+        self.assertIn("-b /ci/u1404@3/$f /ci/rci_1/$f", self.commands[0])
+
+    def test_zfs_get_versions(self):
+        zfs = self._get_storage(virsh.ZFS, "tank/ci/u1404@1\ntank/ci/u1404@3"
+                                "\ntank/ci/u1404@x\n", path="/ci",
+                                dataset="tank/ci")
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual({1, 3},
+                         loop.run_until_complete(zfs.get_versions("u1404")))
+        self.assertTrue(loop.run_until_complete(zfs.exist("u1404")))
+
+
+class GetVMTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.host = virsh.Host.__new__(virsh.Host)
+        self.host.root = Mock(loop=self.loop)
+        self.host._owned = set()
+        self.host._image_users = collections.Counter()
+        self.host.image_versions = {}
+        self.host.image_built_at = {}
+        self.host.image_locks = {}
+        self.host._reservations = {}
+        self.host.la = self.host.free = 0
+        self.host.ssh = get_fake_ssh()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test__get_vm_cancelled(self):
+        loop = self.loop
+        host = self.host
+        commands = []
+        destroyed = []
+
+        @asyncio.coroutine
+        def run(cmd, **kwargs):
+            commands.append(cmd[:2])
+            if cmd[:2] == ["virsh", "create"]:
+                yield from asyncio.sleep(10, loop=loop)
+
+        @asyncio.coroutine
+        def clone(image, name, version):
+            pass
+
+        @asyncio.coroutine
+        def list_files(name):
+            return ["/ci/%s/vda.qcow2" % name]
+
+        @asyncio.coroutine
+        def destroy(name):
+            destroyed.append(name)
+
+        host.ssh.run = run
+        host.storage = Mock(clone=clone, list_files=list_files,
+                            destroy=destroy)
+        fut = asyncio.async(host._get_vm("dsvm", {"net": ["virbr0"]}),
+                            loop=loop)
+        loop.call_later(0.01, fut.cancel)
+        self.assertRaises(asyncio.CancelledError, loop.run_until_complete,
+                          fut)
+        self.assertEqual([["virsh", "create"], ["virsh", "destroy"]],
+                         commands)
+        self.assertEqual(1, len(destroyed))
+        self.assertTrue(destroyed[0].startswith("rci_dsvm"))
+        self.assertEqual(set(), host._owned)
+        self.assertEqual({}, dict(host._image_users))
+
+    def test__get_vm_image_lost(self):
+        host = self.host
+        host.provider = Mock(image_registry={"u1404": 1})
+        host.config = {"images": {"u1404": {"url": "http://u1404"}}}
+        host.image_versions = {"u1404": {1}}
+        stored = set()
+        calls = []
+
+        @asyncio.coroutine
+        def clone(image, name, version):
+            calls.append("clone")
+            if version not in stored:
+                raise Exception("no such image")
+
+        @asyncio.coroutine
+        def get_versions(name):
+            return set(stored)
+
+        @asyncio.coroutine
+        def download(name, url, sha256):
+            calls.append("download")
+
+        @asyncio.coroutine
+        def snapshot(name, version):
+            stored.add(int(version))
+
+        @asyncio.coroutine
+        def noop(*args):
+            return []
+
+        host.storage = Mock(clone=clone, get_versions=get_versions,
+                            download=download, snapshot=snapshot,
+                            list_files=noop, destroy=noop)
+        vm = self.loop.run_until_complete(host._get_vm("dsvm",
+                                                       {"image": "u1404",
+                                                        "net": []}))
+        self.assertEqual(["clone", "download", "clone"], calls)
+        self.assertEqual(("u1404", 1), vm.image)
+        self.assertEqual({}, host.provider.image_registry)
+
+
+class ImageVersionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.host = virsh.Host.__new__(virsh.Host)
+        self.host.image_versions = {"u1404": {1, 2, 3}}
+        self.host._image_users = collections.Counter()
+        self.host._reservations = {}
+        self.host.ssh = Mock(hostname="h1")
+        self.host.la = self.host.free = 0
+        self.destroyed = []
+
+        @asyncio.coroutine
+        def destroy_version(name, version):
+            self.destroyed.append("%s@%s" % (name, version))
+
+        self.host.storage = Mock()
+        self.host.storage.destroy_version = destroy_version
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_gc_image(self):
+        self.host.use_image("u1404", 2)
+        self.loop.run_until_complete(self.host.gc_image("u1404"))
+        self.assertEqual(["u1404@1"], self.destroyed)
+        self.assertEqual({2, 3}, self.host.image_versions["u1404"])
+        self.loop.run_until_complete(self.host.release_image("u1404", 2))
+        self.assertEqual(["u1404@1", "u1404@2"], self.destroyed)
+        self.assertEqual({3}, self.host.image_versions["u1404"])
+
+
+class EventsTestCase(unittest.TestCase):
+
+    def test__handle_event(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        host = virsh.Host.__new__(virsh.Host)
+        host.root = Mock(loop=loop)
+        host._stop_waiters = collections.defaultdict(list)
+        host._domain_watchers = {}
+        stopped = host.domain_stopped("rci_1")
+        died = Mock()
+        host.watch_domain("rci_2", died)
+        host._handle_event("event 'lifecycle' for domain rci_1: "
+                           "Started Booted")
+        self.assertFalse(stopped.done())
+        host._handle_event("event 'lifecycle' for domain rci_1: "
+                           "Stopped Shutdown")
+        self.assertEqual("Shutdown", stopped.result())
+        host._handle_event("event 'lifecycle' for domain rci_2: "
+                           "Crashed Panicked")
+        died.assert_called_once_with("Crashed Panicked")
+        self.assertEqual({}, host._domain_watchers)
+
+
+class BridgesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.host = virsh.Host.__new__(virsh.Host)
+        self.host._bridges = None
+        self.host._owned = set()
+        self.host.bridge_lock = asyncio.Lock(loop=self.loop)
+        self.commands = []
+        self.host.ssh = get_fake_ssh("1: lo: <LOOPBACK>\n5: br0: <BROADCAST>\n"
+                                     "6: br2: <BROADCAST>\n"
+                                     "7: virbr0: <BROADCAST>\n",
+                                     self.commands)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test__get_bridge(self):
+        get = self.host._get_bridge
+        self.assertEqual("br1", self.loop.run_until_complete(get("br")))
+        self.assertEqual("br3", self.loop.run_until_complete(get("br")))
+        self.assertEqual("ip link add br1 type bridge && ip link set br1 up",
+                         self.commands[0])
+        self.loop.run_until_complete(self.host._delete_bridges(["br1"]))
+        self.assertEqual("ip link del br1", self.commands[-1])
+        self.assertEqual("br1", self.loop.run_until_complete(get("br")))
+        self.assertEqual(4, len(self.commands))
+
+
+class ReapOrphansTestCase(unittest.TestCase):
+
+    def test_reap_orphans(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        host = virsh.Host.__new__(virsh.Host)
+        host.root = Mock(loop=loop)
+        host.config = {"vms": {"dsvm": {"net": ["virbr0", "br% 1"]}}}
+        host._owned = {"rci_live", "rci_live_disk", "br1"}
+        host._bridges = {"br": {0, 1}, "virbr": {0}}
+        host.bridge_lock = asyncio.Lock(loop=loop)
+        destroyed = []
+        outputs = {
+            "list": "rci_live\nrci_dead\nother\n",
+            "dominfo": "Used memory:    2097152 KiB\n",
+            "for": "br0\n",
+        }
+
+        def output(cmd):
+            cmd = (cmd if isinstance(cmd, str) else " ".join(cmd)).split()
+            return outputs.get(cmd[0], outputs.get(cmd[1], ""))
+
+        @asyncio.coroutine
+        def list_names():
+            return {"rci_live_disk": 100, "rci_dead_disk": 2048, "u1404": 1}
+
+        @asyncio.coroutine
+        def destroy(name):
+            destroyed.append(name)
+
+        host.ssh = get_fake_ssh(output)
+        host.storage = Mock(list_names=list_names, destroy=destroy)
+        report = loop.run_until_complete(host.reap_orphans())
+        self.assertEqual({"domains": 1, "memory": 2048, "volumes": 1,
+                          "disk": 2048, "bridges": 1}, report)
+        self.assertEqual(["rci_dead_disk"], destroyed)
+        self.assertEqual({1}, host._bridges["br"])
+
+
+class VMTestCase(unittest.TestCase):
+
+    def test_to_xml(self):
+        vm = virsh.VM(Mock(), "dsvm", {"memory": 2048, "vcpu": 2})
+        vm.add_disk("/ci/rci_dsvm/vda.qcow2")
+        vm.add_net("virbr0", mac="52:54:00:00:00:01")
+        vm.add_net("br1")
+        x = ElementTree.fromstring(vm.to_xml())
+        self.assertEqual(vm.name, x.find("name").text)
+        self.assertEqual("2048", x.find("memory").text)
+        self.assertEqual("2", x.find("vcpu").text)
+        disk = x.find("devices/disk")
+        self.assertEqual("/ci/rci_dsvm/vda.qcow2",
+                         disk.find("source").get("file"))
+        self.assertEqual("vda", disk.find("target").get("dev"))
+        nets = x.findall("devices/interface")
+        self.assertEqual(["virbr0", "br1"],
+                         [n.find("source").get("bridge") for n in nets])
+        self.assertEqual(vm.macs, [n.find("mac").get("address") for n in nets])
+        self.assertIs(virsh.get_domain_template(2048, 2),
+                      virsh.get_domain_template(2048, 2))
+
+    def test_get_ssh_error(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        host = Mock(_owned=set())
+        ssh = host.root.ssh_pool.get.return_value
+
+        @asyncio.coroutine
+        def wait():
+            raise ConnectionRefusedError()
+
+        ssh.wait = wait
+        vm = virsh.VM(host, "dsvm")
+        vm.ip = "10.0.0.2"
+        self.assertRaises(ConnectionRefusedError, loop.run_until_complete,
+                          vm.get_ssh())
+        host.root.ssh_pool.put.assert_called_once_with(ssh, close=True)
+        self.assertEqual({}, vm._ssh_cache)
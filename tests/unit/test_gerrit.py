@@ -12,9 +12,15 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
+import collections
+import json
+import os
+import tempfile
 import unittest
 from unittest import mock
 
+from rallyci import journal
 from rallyci.services import gerrit
 
 
@@ -43,20 +49,199 @@ class GerritTestCase(unittest.TestCase):
 
     def test_handle_stdout(self):
         expected_calls = []
-        g = gerrit.Service(mock.Mock(), **{"name": "eggs", "ssh": {}})
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {}})
         g._handle_event = he = mock.Mock()
 
         g._handle_stdout("12")
         self.assertEqual(expected_calls, he.mock_calls)
 
         g._handle_stdout("3\n")
-        expected_calls += [mock.call("123")]
+        expected_calls += [mock.call(b"123")]
         self.assertEqual(expected_calls, he.mock_calls)
 
         g._handle_stdout("456\n789")
-        expected_calls += [mock.call("456")]
+        expected_calls += [mock.call(b"456")]
         self.assertEqual(expected_calls, he.mock_calls)
 
         g._handle_stdout("\n0ab\n")
-        expected_calls += [mock.call("789"), mock.call("0ab")]
+        expected_calls += [mock.call(b"789"), mock.call(b"0ab")]
         self.assertEqual(expected_calls, he.mock_calls)
+
+    def test_handle_stdout_filter(self):
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        root.config.is_project_configured = lambda p: p == "spam/eggs"
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {}})
+        g._handle_event = he = mock.Mock()
+        g._handle_stdout(b'{"change":{"project":"foo/bar"}}\n'
+                         b'{"refUpdate":{"project" : "spam/eggs"}}\n')
+        he.assert_called_once_with(b'{"refUpdate":{"project" : "spam/eggs"}}')
+        self.assertEqual(1, root.stats["gerrit-events-filtered"])
+        self.assertEqual(2, root.stats["gerrit-events-received"])
+
+    def test_handle_stdout_split_multibyte(self):
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        root.config.is_project_configured = lambda p: p == "caf\xe9"
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {}})
+        g._dispatch_event = de = mock.Mock()
+        g._handle_stdout(b'{"type":"x","change":{"project":"caf\xc3')
+        g._handle_stdout(b'\xa9"}}\n')
+        de.assert_called_once_with({"type": "x",
+                                    "change": {"project": "caf\xe9"}})
+
+    @mock.patch("rallyci.services.gerrit.task.Task")
+    def test__start_task_supersede(self, mock_task):
+        root = mock.Mock()
+        root.start_task.return_value = True
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {}})
+
+        def get_event(number):
+            return {"type": "patchset-created",
+                    "change": {"project": "spam", "branch": "master",
+                               "id": "I42"},
+                    "patchSet": {"number": str(number),
+                                 "revision": "rev%d" % number}}
+
+        task1 = mock.Mock(event=mock.Mock(raw_event=get_event(1)))
+        task2 = mock.Mock(event=mock.Mock(raw_event=get_event(2)))
+        mock_task.side_effect = [task1, task2, mock.Mock()]
+        g._start_task(get_event(1))
+        self.assertFalse(root.cancel_task.called)
+        g._start_task(get_event(2))
+        root.cancel_task.assert_called_once_with(task1)
+        self.assertTrue(task1.superseded)
+        self.assertEqual({("spam", "master", "I42"): task2}, g.changes)
+        g._start_task(get_event(1))
+        root.cancel_task.assert_called_once_with(task1)
+        self.assertEqual(2, root.start_task.call_count)
+        self.assertEqual(2, mock_task.call_count)
+
+        g.publish_queue = mock.Mock()
+        g._handle_task_end(task1)
+        self.assertFalse(root.journal.record.called)
+        self.assertFalse(g.publish_queue.put_nowait.called)
+
+        g._forget_task(task2)
+        self.assertEqual({}, g.changes)
+
+    def test__handle_ref_updated_coalesce(self):
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {},
+                                    "merge-coalesce-window": 30})
+        g._start_task = mock.Mock()
+
+        def get_event(rev, ref="master"):
+            return {"type": "ref-updated",
+                    "refUpdate": {"project": "spam", "refName": ref,
+                                  "newRev": rev}}
+
+        for rev in ("r1", "r2", "r3"):
+            g._handle_ref_updated(get_event(rev))
+        g._handle_ref_updated(get_event("r4", ref="stable"))
+        self.assertFalse(g._start_task.called)
+        self.assertEqual(2, root.loop.call_later.call_count)
+        self.assertEqual(2, root.stats["gerrit-merged-runs-saved"])
+
+        g._flush_merge(("spam", "refs/heads/master"))
+        g._start_task.assert_called_once_with(get_event("r3"))
+
+    @mock.patch("rallyci.services.gerrit.time")
+    def test__catch_up(self, mock_time):
+        mock_time.time.return_value = 1000
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        root.config.get_configured_projects.return_value = ["a", "b"]
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {}})
+        g._dispatch_event = mock.Mock()
+        changes = [
+            {"project": "a", "branch": "master", "id": "I1", "url": "u1",
+             "status": "NEW", "lastUpdated": 900,
+             "currentPatchSet": {"revision": "r1", "createdOn": 900}},
+            {"project": "a", "branch": "master", "id": "I2", "url": "u2",
+             "status": "NEW", "lastUpdated": 900,
+             "currentPatchSet": {"revision": "r2", "createdOn": 100}},
+            {"project": "b", "branch": "master", "id": "I3", "url": "u3",
+             "status": "MERGED", "lastUpdated": 950,
+             "currentPatchSet": {"revision": "r3", "createdOn": 100}},
+            {"project": "b", "branch": "master", "id": "I4", "url": "u4",
+             "status": "NEW", "lastUpdated": 950,
+             "currentPatchSet": {"revision": "r4", "createdOn": 950}},
+            {"project": "b", "branch": "stable", "id": "I5", "url": "u5",
+             "status": "MERGED", "lastUpdated": 960,
+             "currentPatchSet": {"revision": "r5", "createdOn": 100}},
+            {"type": "stats", "rowCount": 5},
+        ]
+        g._remember_key("br4")
+        g._handle_event(json.dumps({
+            "type": "ref-updated", "eventCreatedOn": 970,
+            "refUpdate": {"project": "b", "refName": "refs/heads/stable",
+                          "newRev": "m5"}}).encode("utf-8"))
+        g._dispatch_event.reset_mock()
+
+        @asyncio.coroutine
+        def out(cmd):
+            return 0, "\n".join(json.dumps(c) for c in changes), ""
+
+        g.ssh = mock.Mock(out=out)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(g._catch_up(800))
+        loop.close()
+        events = [c[0][0] for c in g._dispatch_event.call_args_list]
+        self.assertEqual(["patchset-created", "ref-updated"],
+                         [e["type"] for e in events])
+        self.assertEqual("r1", events[0]["patchSet"]["revision"])
+        self.assertEqual("I1", events[0]["change"]["id"])
+        self.assertEqual({"project": "b", "refName": "refs/heads/master",
+                          "newRev": "r3"}, events[1]["refUpdate"])
+        self.assertEqual(2, root.stats["gerrit-events-replayed"])
+
+    def test_publish(self):
+        root = mock.Mock()
+        root.stats = collections.Counter()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        root.journal = journal.Journal(loop, os.path.join(tmpdir.name,
+                                                          "journal.log"))
+        root.journal.load()
+        root.journal.record({"type": "review", "id": "t0", "service": "eggs",
+                             "cmd": ["gerrit", "review", "old"]})
+        g = gerrit.Service(root, **{"name": "eggs", "ssh": {},
+                                    "publish-retry-delay": 0})
+        g.publish_queue = asyncio.Queue(loop=loop)
+        g._load_unpublished()
+        g._get_review_cmd = mock.Mock(return_value=["gerrit", "review", "r"])
+        g._handle_task_end(mock.Mock(id="t1", superseded=False,
+                                     cancelled=False))
+        self.assertEqual([["gerrit", "review", "old"],
+                          ["gerrit", "review", "r"]],
+                         [r["cmd"] for r in root.journal.reviews.values()])
+
+        attempts = []
+
+        @asyncio.coroutine
+        def run(cmd):
+            attempts.append(cmd)
+            if len(attempts) < 3:
+                raise Exception("gerrit is down")
+
+        g.ssh = mock.Mock(run=run)
+        g.cfg["publish-retries"] = 1
+        review_id, cmd = loop.run_until_complete(g.publish_queue.get())
+        loop.run_until_complete(g.publish(cmd, review_id))
+        self.assertEqual(2, len(attempts))
+        self.assertIn(review_id, root.journal.reviews)
+        g.cfg["publish-retries"] = 5
+        loop.run_until_complete(g.publish(cmd, review_id))
+        review_id, cmd = loop.run_until_complete(g.publish_queue.get())
+        loop.run_until_complete(g.publish(cmd, review_id))
+        self.assertEqual(4, len(attempts))
+        loop.run_until_complete(root.journal.close())
+        reloaded = journal.Journal(loop, root.journal.filename)
+        reloaded.load()
+        self.assertEqual({}, reloaded.reviews)
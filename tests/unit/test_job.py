@@ -0,0 +1,147 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import unittest
+from unittest import mock
+
+from rallyci.job import Job
+
+
+class JobTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.task = mock.Mock()
+        self.task.root.loop = self.loop
+        self.task.event.env = {}
+        self.task.id = "t"
+        self.task.started_at = 0
+        config = {"name": "j", "provider": "p",
+                  "vms": [{"name": "vm1"}, {"name": "vm2"}, {"name": "vm3"}]}
+        with mock.patch("rallyci.job.Job.__del__"):
+            self.job = Job(self.task, config)
+        self.job.provider = mock.Mock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test__get_vms(self):
+        booting = []
+
+        @asyncio.coroutine
+        def get_vm(name, job):
+            booting.append(name)
+            yield from asyncio.sleep(0.01, loop=self.loop)
+            self.assertEqual(3, len(booting))
+            return name + "-vm"
+
+        self.job.provider.get_vm = get_vm
+        self.loop.run_until_complete(self.job._get_vms())
+        self.assertEqual(["vm1-vm", "vm2-vm", "vm3-vm"],
+                         [vm for vm, conf in self.job.vms])
+        self.assertEqual(3, len(self.job.vm_timings))
+
+    def test__get_vms_failure(self):
+        cancelled = []
+
+        @asyncio.coroutine
+        def get_vm(name, job):
+            if name == "vm2":
+                raise ValueError(name)
+            try:
+                yield from asyncio.sleep(10, loop=self.loop)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+
+        self.job.provider.get_vm = get_vm
+        self.assertRaises(ValueError, self.loop.run_until_complete,
+                          self.job._get_vms())
+        self.assertEqual(["vm1", "vm3"], sorted(cancelled))
+        self.assertEqual([], self.job.vms)
+
+    def _get_vm(self, name, events):
+        ssh = mock.Mock()
+
+        @asyncio.coroutine
+        def run(cmd, stdin, **kwargs):
+            events.append((name, stdin))
+            yield from asyncio.sleep(0.01 if name == "vm1" else 0,
+                                     loop=self.loop)
+            return 1 if stdin == "fail" else 0
+
+        @asyncio.coroutine
+        def get_ssh(user):
+            return ssh
+
+        ssh.run = run
+        vm = mock.Mock()
+        vm.get_ssh = get_ssh
+        return vm
+
+    def test__run_scripts_concurrent(self):
+        events = []
+        self.job.config["concurrent"] = True
+        self.task.root.config.get_script = lambda name, cfg: {"data": name}
+        self.job.vms = [
+            (self._get_vm("vm1", events),
+             {"scripts": ["a1", {"barrier": "b"}, "a2"]}),
+            (self._get_vm("vm2", events),
+             {"scripts": ["b1", "b2", {"barrier": "b"}, "b3"]}),
+        ]
+        e = self.loop.run_until_complete(self.job._run_scripts("scripts"))
+        self.assertIsNone(e)
+        order = [stdin for name, stdin in events]
+        self.assertEqual(["a1", "b1", "b2"], order[:3])
+        self.assertEqual({"a2", "b3"}, set(order[3:]))
+
+    def test__run_scripts_concurrent_failure(self):
+        events = []
+        self.job.config["concurrent"] = True
+        self.task.root.config.get_script = lambda name, cfg: {"data": name}
+        self.job.vms = [
+            (self._get_vm("vm1", events),
+             {"scripts": ["a1", {"barrier": "b"}, "a2"]}),
+            (self._get_vm("vm2", events),
+             {"scripts": ["fail", {"barrier": "b"}, "b2"]}),
+        ]
+        e = self.loop.run_until_complete(self.job._run_scripts("scripts"))
+        self.assertEqual(1, e)
+        self.assertEqual(["a1", "fail"], [stdin for name, stdin in events])
+
+    @mock.patch("rallyci.job.os")
+    @mock.patch("rallyci.job.open", create=True)
+    def test__run_vm_died(self, mock_open, mock_os):
+        vm = mock.Mock()
+
+        @asyncio.coroutine
+        def get_vm(name, job):
+            return vm
+
+        @asyncio.coroutine
+        def run_scripts(key):
+            self.job.vm_died(vm, "Stopped Failed")
+            yield from asyncio.sleep(10, loop=self.loop)
+
+        @asyncio.coroutine
+        def acquire(job):
+            pass
+
+        self.task.root.providers = {"p": self.job.provider}
+        self.task.root.scheduler.acquire = acquire
+        self.job.provider.get_vm = get_vm
+        self.job._run_scripts = run_scripts
+        self.assertRaisesRegex(Exception, "Stopped Failed",
+                               self.loop.run_until_complete, self.job._run())
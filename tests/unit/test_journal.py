@@ -0,0 +1,72 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from rallyci.journal import Journal
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, "pub", "journal.log")
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _reload(self):
+        journal = Journal(self.loop, self.filename, keep_finished=1)
+        journal.load()
+        return journal
+
+    def test_replay(self):
+        journal = self._reload()
+        result = {"status": "SUCCESS", "error": 0, "started_at": 1,
+                  "finished_at": 2, "log_path": "t1/j1"}
+        for task in ("t1", "t2", "t3"):
+            journal.record({"type": "task-started", "task": task,
+                            "service": "gerrit", "raw_event": {"n": task}})
+        journal.record({"type": "job-status", "task": "t1", "job": "j1",
+                        "status": "queued"})
+        journal.record({"type": "job-status", "task": "t1", "job": "j1",
+                        "status": "SUCCESS", "result": result})
+        for task in ("t2", "t3"):
+            journal.record({"type": "task-finished", "task": task,
+                            "summary": {"id": task}})
+        journal.record({"type": "review", "id": "t2", "service": "gerrit",
+                        "cmd": ["gerrit", "review"]})
+        journal.record({"type": "review", "id": "t3", "service": "gerrit",
+                        "cmd": ["gerrit", "review"]})
+        journal.record({"type": "published", "id": "t3"})
+        self.loop.run_until_complete(journal.close())
+        journal.record({"type": "task-finished", "task": "t1"})
+        with open(self.filename, "a") as f:
+            f.write('{"type": "task-fin')
+
+        for i in range(2):
+            journal = self._reload()
+            self.assertEqual({"t1": {"service": "gerrit",
+                                     "raw_event": {"n": "t1"},
+                                     "jobs": {"j1": result}}},
+                             journal.tasks)
+            self.assertEqual(["t2"], list(journal.reviews))
+            self.assertEqual([{"id": "t3"}], list(journal.finished))
+        with open(self.filename) as f:
+            self.assertEqual(4, len(f.readlines()))
@@ -0,0 +1,79 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import collections
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from rallyci.journal import Journal
+from rallyci.root import Root
+
+
+class RootTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filename = os.path.join(tmpdir.name, "journal.log")
+        self.ids = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _get_root(self):
+        root = Root.__new__(Root)
+        root.loop = self.loop
+        root.log = mock.Mock()
+        root.stats = collections.Counter()
+        root.tasks = {}
+        root.task_set = set()
+        root.start_obj = mock.Mock()
+        root.journal = Journal(self.loop, self.filename)
+        root.journal.load()
+        service = mock.Mock()
+        ids = self.ids
+
+        def resume_task(raw_event, results):
+            task = mock.Mock(results=results, id="t%d" % (len(ids) + 2))
+            ids.append(task.id)
+            task.event = mock.Mock(key=task.id, service="gerrit",
+                                   raw_event=raw_event)
+            root.start_task(task)
+
+        service.resume_task = resume_task
+        root.services = {"gerrit": service}
+        return root
+
+    def test_resume_tasks_twice(self):
+        result = {"status": "SUCCESS", "error": 0, "started_at": 1,
+                  "finished_at": 2, "log_path": "t1/j1"}
+        journal = Journal(self.loop, self.filename)
+        journal.load()
+        journal.record({"type": "task-started", "task": "t1",
+                        "service": "gerrit", "raw_event": {}})
+        journal.record({"type": "job-status", "task": "t1", "job": "j1",
+                        "status": "SUCCESS", "result": result})
+        self.loop.run_until_complete(journal.close())
+
+        for task_id in ("t1", "t2", "t3"):
+            root = self._get_root()
+            self.assertEqual([task_id], list(root.journal.tasks))
+            self.assertEqual({"j1": result},
+                             root.journal.tasks[task_id]["jobs"])
+            root.resume_tasks()
+            self.loop.run_until_complete(root.journal.close())
@@ -0,0 +1,93 @@
+# Copyright 2016: Mirantis Inc.
+# All Rights Reserved.
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import asyncio
+import unittest
+from unittest import mock
+
+from rallyci import scheduler
+
+
+def _get_job(name, voting=False, event_type="patchset-created"):
+    job = mock.Mock(voting=voting, event_type=event_type)
+    job.config = {"provider": "p1", "name": name}
+    return job
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.root = mock.Mock(loop=self.loop)
+        self.root.config.data = {"provider": {"p1": {"max-jobs": 1}}}
+        self.scheduler = scheduler.Scheduler(self.root)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_get_priority(self):
+        self.assertEqual(scheduler.PRIORITY_VOTING,
+                         scheduler.get_priority(_get_job("j", True)))
+        self.assertEqual(scheduler.PRIORITY_NON_VOTING,
+                         scheduler.get_priority(_get_job("j")))
+        job = _get_job("j", event_type="change-merged")
+        self.assertEqual(scheduler.PRIORITY_MERGED,
+                         scheduler.get_priority(job))
+
+    def test_acquire_release_priority(self):
+        started = []
+        first = _get_job("first")
+        jobs = [_get_job("merged", event_type="change-merged"),
+                _get_job("non-voting"),
+                _get_job("voting", voting=True)]
+
+        @asyncio.coroutine
+        def run(job):
+            yield from self.scheduler.acquire(job)
+            started.append(job.config["name"])
+
+        @asyncio.coroutine
+        def test():
+            yield from run(first)
+            futs = [asyncio.async(run(job), loop=self.loop) for job in jobs]
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.assertEqual(["first"], started)
+            self.assertEqual({"p1": {"queued": 3, "running": 1}},
+                             self.scheduler.get_stats())
+            by_name = {j.config["name"]: j for j in [first] + jobs}
+            for i in range(4):
+                self.scheduler.release(by_name[started[i]])
+                yield from asyncio.sleep(0, loop=self.loop)
+            yield from asyncio.wait(futs, loop=self.loop)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual(["first", "voting", "non-voting", "merged"], started)
+
+    def test_cancel_queued(self):
+        job1 = _get_job("j1")
+        job2 = _get_job("j2")
+
+        @asyncio.coroutine
+        def test():
+            yield from self.scheduler.acquire(job1)
+            fut = asyncio.async(self.scheduler.acquire(job2), loop=self.loop)
+            yield from asyncio.sleep(0, loop=self.loop)
+            fut.cancel()
+            yield from asyncio.sleep(0, loop=self.loop)
+            self.scheduler.release(job1)
+            self.scheduler.release(job2)
+
+        self.loop.run_until_complete(test())
+        self.assertEqual({"p1": {"queued": 0, "running": 0}},
+                         self.scheduler.get_stats())
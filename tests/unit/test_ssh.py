@@ -1,5 +1,8 @@
 from rallyci.common import ssh
+import asyncio
+import io
 import unittest
+from unittest import mock
 
 
 class SSHTestCase(unittest.TestCase):
@@ -10,3 +13,76 @@ class SSHTestCase(unittest.TestCase):
     def test__escape_env(self):
         env = {"FOO": "BAR"}
         self.assertEqual("FOO='BAR' ", ssh._escape_env(env))
+
+    @mock.patch("rallyci.common.ssh.time")
+    def test_pool(self, mock_time):
+        mock_time.time.return_value = 0
+        pool = ssh.SSHPool(mock.Mock(), idle_timeout=10)
+        s1 = pool.get("h1", username="root", keys=["k"])
+        s2 = pool.get("h1", username="root", keys=["k"])
+        s3 = pool.get("h1", username="rally", keys=["k"])
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertEqual({"hits": 1, "misses": 2, "connections": 2,
+                          "idle": 0}, pool.get_stats())
+
+        s1.close = mock.Mock()
+        s3.close = mock.Mock()
+        pool.put(s3, close=True)
+        s3.close.assert_called_once_with()
+        pool.put(s1)
+        pool.put(s2)
+        self.assertFalse(s1.close.called)
+        self.assertEqual(1, pool.get_stats()["idle"])
+        mock_time.time.return_value = 11
+        pool.evict()
+        s1.close.assert_called_once_with()
+        self.assertEqual(0, pool.get_stats()["connections"])
+
+    def test__write_stdin(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        class Session:
+            drained = 0
+
+            @asyncio.coroutine
+            def drain(self):
+                self.drained += 1
+
+        class Reader:
+            def __init__(self, chunks):
+                self.chunks = chunks
+
+            @asyncio.coroutine
+            def read(self, n):
+                return self.chunks.pop(0) if self.chunks else b""
+
+        big = b"\xff" * (ssh.CHUNK_SIZE + 1)
+        for stdin, expected in (
+                ("тест", [b"\xd1\x82\xd0\xb5\xd1\x81\xd1\x82"]),
+                (big, [big[:ssh.CHUNK_SIZE], b"\xff"]),
+                (io.BytesIO(big), [big[:ssh.CHUNK_SIZE], b"\xff"]),
+                (Reader(["a", b"b"]), [b"a", b"b"])):
+            chan = mock.Mock()
+            session = Session()
+            loop.run_until_complete(ssh._write_stdin(chan, session, stdin))
+            self.assertEqual([mock.call(c) for c in expected],
+                             chan.write.mock_calls)
+            self.assertEqual(len(expected), session.drained)
+
+    def test_pipe_flow_control(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        chan = mock.Mock()
+        buf = ssh.Pipe(loop, high_water=4)
+        buf.set_channel(chan)
+        buf(b"abcd")
+        self.assertFalse(chan.pause_reading.called)
+        buf(b"e")
+        chan.pause_reading.assert_called_once_with()
+        buf.feed_eof()
+        self.assertEqual(b"abcd", loop.run_until_complete(buf.read()))
+        chan.resume_reading.assert_called_once_with()
+        self.assertEqual(b"e", loop.run_until_complete(buf.read()))
+        self.assertEqual(b"", loop.run_until_complete(buf.read()))
@@ -12,6 +12,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
 import unittest
 from unittest import mock
 
@@ -27,3 +28,50 @@ class TaskTestCase(unittest.TestCase):
         event = mock.Mock()
         t = Task(root, event)
         self.assertEqual([], t.jobs)
+
+    @mock.patch("rallyci.task.Job.__del__")
+    @mock.patch("rallyci.task.Task.__del__")
+    def test_run_restored(self, mock_del, mock_job_del):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        root = mock.Mock(loop=loop, task_start_handlers=[])
+        root.config.get_jobs.side_effect = [[{"name": "j1"}], []]
+        event = mock.Mock(cfg_url="", event_type="patchset-created", env={})
+        result = {"status": "FAILURE", "error": 1, "started_at": 1,
+                  "finished_at": 2, "log_path": "old/j1"}
+        t = Task(root, event, {"j1": result})
+        loop.run_until_complete(t.run())
+        self.assertFalse(root.start_obj.called)
+        self.assertEqual([("FAILURE", 1, "old/j1")],
+                         [(j.status, j.error, j.log_path) for j in t.jobs])
+        self.assertIsNotNone(t.finished_at)
+
+    @mock.patch("rallyci.task.Task.__del__")
+    def test_run_cancel_waits_jobs(self, mock_del):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        root = mock.Mock(loop=loop, task_start_handlers=[])
+        event = mock.Mock(cfg_url="")
+        t = Task(root, event)
+        finished = []
+
+        @asyncio.coroutine
+        def job_run():
+            try:
+                yield from asyncio.sleep(10, loop=loop)
+            except asyncio.CancelledError:
+                yield from asyncio.sleep(0, loop=loop)
+                finished.append(True)
+
+        def start_jobs():
+            t.jobs.append(mock.Mock())
+            fut = asyncio.async(job_run(), loop=loop)
+            t._job_futures[fut] = t.jobs[0]
+
+        t._start_jobs = start_jobs
+        fut = asyncio.async(t.run(), loop=loop)
+        loop.call_later(0.01, fut.cancel)
+        loop.run_until_complete(fut)
+        self.assertEqual([True], finished)
+        self.assertTrue(t.cancelled)
+        self.assertIsNotNone(t.finished_at)
@@ -60,3 +60,11 @@ class UtilsTestCase(unittest.TestCase):
         }
         utils.expand_jobs(config)
         self.assertEqual(expanded_config, config)
+
+    def test_line_framer(self):
+        framer = utils.LineFramer(max_line=8)
+        self.assertEqual([], framer.feed(b"12"))
+        self.assertEqual([b"123"], framer.feed("3\n"))
+        self.assertEqual([b"456", b""], framer.feed(b"456\n\n7"))
+        self.assertEqual([], framer.feed(b"890abcdefg"))
+        self.assertEqual([b"ok"], framer.feed(b"hij\nok\n"))